@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''
+Benchmark fillbib against local stand-ins of ADS and INSPIRE (see mock_servers.py), so that
+regressions can be caught without hitting the real services.
+
+For each corpus size, a synthetic document (aux file citing ADS bibcodes, arXiv preprints and INSPIRE
+texkeys, plus a bib file with some of them already in) is built in a temporary directory, and we time
+`fillbib tex` and `fillbib list` on it. The fetch, parse and journal-normalization stages are also
+timed on their own. For each run we report wall time, requests issued, bytes transferred and peak memory,
+and check the result: the entries written or printed, and no requests at all when nothing changed.
+
+Usage:
+python bench_fillbib.py [--sizes 10 100 1000 10000] [--latency 0.02] [--error-rate 0.01] [--json results.json]
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import os, sys, time, json, tempfile, shutil, subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FILLBIB = os.path.join(HERE, os.pardir, 'bin', 'fillbib')
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+
+import fillbib
+from mock_servers import MockDatabases, ads_entry, inspire_entry, is_missing, published_bibcode
+
+
+def synthetic_keys(n):
+    '''n citation keys: 60% ADS bibcodes, 10% ADS arXiv preprints, 30% INSPIRE texkeys.'''
+    keys = []
+    for i in range(n):
+        if i % 10 < 6:
+            keys.append('{}ApJ...{:03d}.{:04d}X'.format(2000 + i % 20, i % 1000, i // 1000))
+        elif i % 10 < 7:
+            keys.append('{}arXiv{:04d}{:05d}X'.format(2010 + i % 10, 1000 + i % 1000, i))
+        else:
+            keys.append('Author{}:{}ab'.format(i, 2000 + i % 20))
+    return keys
+
+def make_corpus(directory, n, have=0.1):
+    '''Write paper.tex and paper.aux citing n keys, and paper.bib with a fraction `have` of them already in.'''
+    keys = synthetic_keys(n)
+    with open(os.path.join(directory, 'paper.tex'), 'w') as f:
+        f.write('\\documentclass{article}\n\\begin{document}\n')
+        for i in range(0, n, 10):
+            f.write('Some text \\cite{' + ','.join(keys[i:i+10]) + '}.\n')
+        f.write('\\bibliographystyle{plain}\n\\bibliography{paper}\n\\end{document}\n')
+    with open(os.path.join(directory, 'paper.aux'), 'w') as f:
+        for i in range(0, n, 10):
+            f.write('\\citation{' + ','.join(keys[i:i+10]) + '}\n')
+        f.write('\\bibdata{paper}\n')
+    with open(os.path.join(directory, 'paper.bib'), 'w') as f:
+        for c in keys[:int(n*have)]:
+            f.write(inspire_entry(c) if c[0].isalpha() else ads_entry(c))
+    return keys
+
+def expected_keys(keys, miss_rate):
+    '''The keys fillbib should end up with: those in the databases, with preprints replaced by the published record.'''
+    return set(published_bibcode(c) if 'arXiv' in c else c for c in keys if not is_missing(c, miss_rate))
+
+def run_fillbib(arguments, directory, env, stdout=subprocess.DEVNULL):
+    '''Run fillbib in a new process. Returns (wall time in s, peak memory in MB).'''
+    start = time.time()
+    process = subprocess.Popen([sys.executable, FILLBIB] + arguments, cwd=directory, env=env,
+                               stdout=stdout, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    assert status == 0, "fillbib {} failed".format(" ".join(arguments[:3]))
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = usage.ru_maxrss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+    return elapsed, peak
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def clean_journals(bibfile):
+    '''Clean up the journal names of all the records of a bib file, as fillbib does for new entries.'''
+    with open(bibfile, 'r') as f:
+        for key, bib in fillbib.iter_bibtex(f):
+            fillbib.clean_entry(bib)
+
+def benchmark(n, mock, options):
+    '''All measurements for a corpus of n citations.'''
+    directory = tempfile.mkdtemp(prefix='fillbib-bench-')
+    results = []
+    try:
+        keys = make_corpus(directory, n)
+        env = dict(os.environ, FILLTEX_CACHE=os.path.join(directory, 'cache'), **mock.environment())
+        if options.token:
+            env['ADS_TOKEN'] = 'benchmark'
+        else:
+            env.pop('ADS_TOKEN', None)
+        # The cache of the tex runs is in the temporary directory, so it starts empty
+        bibfile = os.path.join(directory, 'paper.bib')
+        expected = expected_keys(keys, options.miss_rate).union(expected_keys(keys[:int(n*0.1)], 0.))
+
+        def record(stage, elapsed, peak=None):
+            results.append({'size': n, 'stage': stage, 'time': elapsed, 'peak_mb': peak,
+                            'requests': mock.stats['requests'], 'bytes': mock.stats['bytes'],
+                            'errors': mock.stats['errors'], 'throttled': mock.stats['throttled']})
+
+        # Whole fillbib tex run (cold: no cache, no index)
+        mock.reset()
+        elapsed, peak = run_fillbib(['tex', 'paper'], directory, env)
+        record('tex', elapsed, peak)
+        assert fillbib.bib_keys(bibfile) == expected, "tex: wrong entries in paper.bib"
+
+        # Same document again: nothing should be downloaded (keys not found come from the cache)
+        mock.reset()
+        elapsed, peak = run_fillbib(['tex', 'paper'], directory, env)
+        record('tex (unchanged)', elapsed, peak)
+        assert mock.stats['requests'] == 0, "tex (unchanged): {} requests".format(mock.stats['requests'])
+        assert fillbib.bib_keys(bibfile) == expected, "tex (unchanged): wrong entries in paper.bib"
+
+        # fillbib list with all the keys on the command line (or as many as fit), without the cache
+        mock.reset()
+        with open(os.path.join(directory, 'list.bib'), 'w+') as output:
+            elapsed, peak = run_fillbib(['--no-cache', 'list'] + keys[:2000], directory, env, stdout=output)
+            output.seek(0)
+            printed = set(key for key, bib in fillbib.iter_bibtex(output) if key)
+        record('list' if n <= 2000 else 'list (2000)', elapsed, peak)
+        assert printed == expected_keys(keys[:2000], options.miss_rate), "list: wrong entries printed"
+
+        # Single stages, in this process
+        if os.path.isfile(fillbib.bib_index_file(bibfile)):
+            os.remove(fillbib.bib_index_file(bibfile))
+        fillbib.BIB_INDEX.clear()
+        mock.reset()
+        record('parse bib', timed(fillbib.bib_keys, bibfile))
+        mock.reset()
+        record('index bib', timed(fillbib.bib_keys, bibfile))
+        mock.reset()
+        record('journals', timed(clean_journals, bibfile))
+
+        args = argparse.Namespace(generate=False, max_num_authors=None, num_authors_short=None,
+                                  journal_arXiv_fallback=False, ads_workers=options.ads_workers,
+                                  inspire_workers=options.inspire_workers, ads_batch=500, inspire_batch=50,
+                                  offline=False, refresh=False, no_cache=True, hedge=False)
+        fillbib.ADS_API = fillbib.ADS_UI = fillbib.INSPIRE_API = mock.url
+        saved = dict(os.environ)
+        if options.token:
+            os.environ['ADS_TOKEN'] = 'benchmark'
+        else:
+            os.environ.pop('ADS_TOKEN', None)
+        try:
+            mock.reset()
+            start = time.time()
+            found = fillbib.fetch_citations(keys, args)
+            record('fetch', time.time() - start)
+            assert set(c for c, bib in found.items() if bib is not None) == set(c for c in keys if not is_missing(c, options.miss_rate)), \
+                "fetch: wrong keys found"
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def print_table(results):
+    print("{:>7} {:<16} {:>9} {:>9} {:>11} {:>8} {:>8}".format("size", "stage", "time [s]", "requests", "kB", "errors", "peak MB"))
+    for r in results:
+        print("{:>7} {:<16} {:>9.3f} {:>9} {:>11.1f} {:>8} {:>8}".format(r['size'], r['stage'], r['time'], r['requests'],
+              r['bytes']/1024., r['errors'] + r['throttled'], "" if r['peak_mb'] is None else "{:.1f}".format(r['peak_mb'])))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000],
+            help="Number of citations of the synthetic documents (default: 10 100 1000 10000)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every answer (default: 0.02)")
+    parser.add_argument("--rate-limit", dest="rate_limit", default=None,
+            help="Server-side rate limit, as requests/seconds (e.g. 15/5)")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0., help="Fraction of requests answered with a 503")
+    parser.add_argument("--miss-rate", dest="miss_rate", type=float, default=0.02, help="Fraction of keys not in the databases (default: 0.02)")
+    parser.add_argument("--num-authors", dest="num_authors", type=int, default=10, help="Number of authors of INSPIRE records")
+    parser.add_argument("--no-token", dest="token", action="store_false",
+            help="Benchmark without ADS_TOKEN (one ADS query per key)")
+    parser.add_argument("--ads-workers", dest="ads_workers", type=int, default=4)
+    parser.add_argument("--inspire-workers", dest="inspire_workers", type=int, default=2)
+    parser.add_argument("--json", help="Also save the results to this file")
+    options = parser.parse_args()
+
+    rate_limit = tuple(float(x) for x in options.rate_limit.split('/')) if options.rate_limit else None
+    mock = MockDatabases(latency=options.latency, rate_limit=rate_limit, error_rate=options.error_rate,
+                         miss_rate=options.miss_rate, num_authors=options.num_authors).start()
+    try:
+        results = []
+        for n in options.sizes:
+            results += benchmark(n, mock, options)
+    finally:
+        mock.stop()
+
+    print_table(results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=1)
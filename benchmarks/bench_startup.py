@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+'''
+Benchmark how long fillbib takes to start when there is nothing to do, which is what editors running
+filltex at every save see most of the time.
+
+A synthetic document is brought up to date once (against the local stand-ins of ADS and INSPIRE, see
+mock_servers.py), then we time `fillbib tex` on it, which should only find out that the citations did not
+change, and compare with a bare python interpreter and with just importing fillbib.
+
+Usage:
+python bench_startup.py [--size 1000] [--runs 20] [--imports 15]
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import os, sys, time, tempfile, shutil, subprocess, compileall
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+LAUNCHER = os.path.join(ROOT, 'bin', 'fillbib')
+
+from mock_servers import MockDatabases
+from bench_fillbib import make_corpus
+
+
+def timings(command, directory, env, runs):
+    '''Wall times in s of `runs` runs of a command.'''
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)
+
+def slowest_imports(command, directory, env, n):
+    '''The n modules which take longest to import (cumulative time in ms), from python -X importtime.'''
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], cwd=directory, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            fields = line[len('import time:'):].split('|')
+            if fields[1].strip().isdigit():
+                imports.append((int(fields[1]) / 1000., fields[2].rstrip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000, help="Number of citations of the document (default: 1000)")
+    parser.add_argument("--runs", type=int, default=20, help="Number of runs of each command (default: 20)")
+    parser.add_argument("--imports", type=int, default=0, help="Also list this many of the slowest imports")
+    options = parser.parse_args()
+
+    # Like an installed copy, run from the compiled bytecode
+    compileall.compile_file(os.path.join(ROOT, 'fillbib.py'), quiet=1)
+
+    directory = tempfile.mkdtemp(prefix='fillbib-startup-')
+    try:
+        make_corpus(directory, options.size)
+        mock = MockDatabases().start()
+        env = dict(os.environ, FILLTEX_CACHE=os.path.join(directory, 'cache'), ADS_TOKEN='benchmark', **mock.environment())
+        try:
+            subprocess.check_call([sys.executable, LAUNCHER, 'tex', 'paper'], cwd=directory, env=env, stdout=subprocess.DEVNULL)
+        finally:
+            mock.stop()
+        # Nothing should be downloaded from now on: make sure of it
+        env = dict(env, FILLBIB_ADS_API='http://127.0.0.1:9', FILLBIB_ADS_UI='http://127.0.0.1:9', FILLBIB_INSPIRE_API='http://127.0.0.1:9')
+
+        commands = [("python", [sys.executable, '-c', 'pass']),
+                    ("import fillbib", [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); import fillbib'.format(ROOT)]),
+                    ("fillbib tex (unchanged)", [sys.executable, LAUNCHER, 'tex', 'paper'])]
+        print("{:<26} {:>9} {:>9}".format("", "min [ms]", "median [ms]"))
+        for name, command in commands:
+            times = timings(command, directory, env, options.runs)
+            print("{:<26} {:>9.1f} {:>9.1f}".format(name, 1000 * times[0], 1000 * times[len(times)//2]))
+
+        if options.imports:
+            print("\nSlowest imports of fillbib tex (cumulative, ms):")
+            for duration, module in slowest_imports(commands[-1][1], directory, env, options.imports):
+                print("{:>9.1f}  {}".format(duration, module))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+'''
+Local stand-ins for the ADS and INSPIRE APIs, to measure fillbib without touching the real services.
+
+The server answers the queries fillbib makes (ADS export and search, ADS abstract page, INSPIRE literature search)
+with synthetic records, and can add latency, enforce a rate limit and inject errors. Point fillbib to it with
+
+    FILLBIB_ADS_API=<url> FILLBIB_ADS_UI=<url> FILLBIB_INSPIRE_API=<url> fillbib ...
+
+Usage:
+python mock_servers.py [--port 8000] [--latency 0.05] [--error-rate 0.01] [--rate-limit 15/5]
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import json, re, time, random, threading, zlib
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def is_missing(key, miss_rate):
+    '''Deterministically decide whether a key is unknown to the databases.'''
+    return zlib.crc32(key.encode()) % 1000 < miss_rate * 1000
+
+def published_bibcode(c):
+    '''The bibcode ADS gives to the published version of a preprint.'''
+    return c[:4] + "PhRvD" + c[9:18].replace('.', '')[:9].rjust(9, '.') + c[-1]
+
+def ads_entry(c):
+    '''A synthetic ADS record, in the format of the ADS export. Preprints come back as the published record.'''
+    key = published_bibcode(c) if 'arXiv' in c else c
+    eprint = c[9:13] + '.' + c[13:18] if 'arXiv' in c else '1602.03837'
+    authors = " and \n\t".join("{{Author{}}}, A.~B.".format(i) for i in range(10))
+    return ('@ARTICLE{' + key + ',\n'
+            '   author = {' + authors + ' and et al.},\n'
+            '    title = "{A synthetic record for ' + c + '}",\n'
+            '  journal = {\\apj},\n'
+            '     year = 2016,\n'
+            '   volume = 116,\n'
+            '    pages = {061102},\n'
+            '   eprint = {' + eprint + '},\n'
+            '      doi = {10.1103/PhysRevLett.116.061102},\n'
+            '   adsurl = {https://ui.adsabs.harvard.edu/abs/' + key + '},\n'
+            '  adsnote = {Provided by the SAO/NASA Astrophysics Data System}\n'
+            '}\n\n')
+
+def inspire_metadata(key, num_authors):
+    '''Synthetic metadata of an INSPIRE record.'''
+    return {'texkeys': [key],
+            'document_type': ['article'],
+            'authors': [{'full_name': 'Author{}, A.B.'.format(i)} for i in range(num_authors)],
+            'collaborations': [{'value': 'LIGO Scientific'}, {'value': 'Virgo'}],
+            'titles': [{'title': 'A synthetic record for ' + key}],
+            'arxiv_eprints': [{'value': '1602.03837', 'categories': ['gr-qc']}],
+            'dois': [{'value': '10.1103/PhysRevLett.116.061102'}],
+            'publication_info': [{'journal_title': 'Phys. Rev. Lett.', 'journal_volume': '116',
+                                  'journal_issue': '6', 'page_start': '061102', 'year': 2016}]}
+
+def inspire_entry(key):
+    '''A synthetic INSPIRE record, in the format of the INSPIRE BibTeX export.'''
+    return ('@article{' + key + ',\n'
+            '    author = "Author0, A.B. and others",\n'
+            '    collaboration = "LIGO Scientific, Virgo",\n'
+            '    title = "{A synthetic record for ' + key + '}",\n'
+            '    eprint = "1602.03837",\n'
+            '    archivePrefix = "arXiv",\n'
+            '    primaryClass = "gr-qc",\n'
+            '    doi = "10.1103/PhysRevLett.116.061102",\n'
+            '    journal = "Phys. Rev. Lett.",\n'
+            '    volume = "116",\n'
+            '    number = "6",\n'
+            '    pages = "061102",\n'
+            '    year = "2016"\n'
+            '}\n\n')
+
+
+class MockDatabases(object):
+    '''
+    A local HTTP server emulating ADS and INSPIRE.
+
+    * latency
+        seconds added to every answer
+    * rate_limit
+        (requests, period): answer 429 to requests beyond this rate
+    * error_rate
+        fraction of requests answered with a 503
+    * miss_rate
+        fraction of keys which are not in the databases
+    * num_authors
+        number of authors of INSPIRE records (large collaborations have thousands)
+    '''
+
+    def __init__(self, port=0, latency=0., rate_limit=None, error_rate=0., miss_rate=0., num_authors=10, seed=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.miss_rate = miss_rate
+        self.num_authors = num_authors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = []
+        self.reset()
+
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                mock.handle(self, None)
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                mock.handle(self, body)
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = None
+
+    def reset(self):
+        '''Reset the counters of requests and bytes.'''
+        with self.lock:
+            self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'throttled': 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def environment(self):
+        '''Environment variables pointing fillbib to this server.'''
+        return {'FILLBIB_ADS_API': self.url, 'FILLBIB_ADS_UI': self.url, 'FILLBIB_INSPIRE_API': self.url}
+
+    def handle(self, request, body):
+        with self.lock:
+            self.stats['requests'] += 1
+            throttled = False
+            if self.rate_limit:
+                now = time.time()
+                self.recent = [t for t in self.recent if now - t < self.rate_limit[1]]
+                throttled = len(self.recent) >= self.rate_limit[0]
+                if not throttled:
+                    self.recent.append(now)
+            failed = not throttled and self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+
+        if throttled:
+            with self.lock:
+                self.stats['throttled'] += 1
+            return self.send(request, 429, b'', headers={'Retry-After': '1'})
+        if failed:
+            with self.lock:
+                self.stats['errors'] += 1
+            return self.send(request, 503, b'')
+
+        url = urllib.parse.urlsplit(request.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = urllib.parse.unquote(url.path)
+
+        if path == '/v1/export/bibtex' and body is not None: # ADS export of many bibcodes
+            keys = json.loads(body.decode())['bibcode']
+            export = "".join(ads_entry(c) for c in keys if not is_missing(c, self.miss_rate))
+            return self.send(request, 200, json.dumps({'msg': 'Retrieved {} abstracts'.format(len(keys)), 'export': export}).encode())
+
+        if path.startswith('/v1/export/bibtex/'): # ADS export of a single bibcode
+            c = path[len('/v1/export/bibtex/'):]
+            if is_missing(c, self.miss_rate):
+                return self.send(request, 404, b'{"error": "no result from solr"}')
+            return self.send(request, 200, ads_entry(c).encode())
+
+        if path == '/v1/search/query': # ADS search, used to find the bibcode of a DOI or arXiv number
+            identifier = re.sub(r'^identifier:"(.*)"$', r'\1', query.get('q', [''])[0])
+            docs = [] if is_missing(identifier, self.miss_rate) else [{'bibcode': '2016PhRvL.116f1102A'}]
+            return self.send(request, 200, json.dumps({'response': {'numFound': len(docs), 'docs': docs}}).encode())
+
+        m = re.match(r'/abs/(.*)/exportcitation', path) # ADS abstract page
+        if m:
+            c = m.group(1)
+            if is_missing(c, self.miss_rate):
+                return self.send(request, 404, b'')
+            page = '<html><body><textarea>' + ads_entry(c).replace('&', '&amp;') + '</textarea></body></html>'
+            return self.send(request, 200, page.encode())
+
+        m = re.match(r'/api/literature/(.*)', path) # Link to the BibTeX of a single INSPIRE record
+        if m:
+            return self.send(request, 200, inspire_entry(m.group(1)).encode())
+
+        if path == '/api/literature': # INSPIRE search
+            q = query.get('q', [''])[0]
+            keys = re.findall(r'texkeys:"([^"]+)"', q) or [q]
+            keys = [c for c in keys if not is_missing(c, self.miss_rate)]
+            size = int(query.get('size', ['10'])[0])
+            page = int(query.get('page', ['1'])[0])
+            keys = keys[(page-1)*size:page*size]
+            if query.get('format') == ['bibtex']:
+                return self.send(request, 200, "".join(inspire_entry(c) for c in keys).encode())
+            hits = [{'metadata': inspire_metadata(c, self.num_authors),
+                     'links': {'bibtex': self.url + '/api/literature/' + urllib.parse.quote(c) + '?format=bibtex'}}
+                    for c in keys]
+            return self.send(request, 200, json.dumps({'hits': {'total': len(hits), 'hits': hits}, 'links': {}}).encode())
+
+        return self.send(request, 404, b'')
+
+    def send(self, request, status, data, headers=None):
+        with self.lock:
+            self.stats['bytes'] += len(data)
+        request.send_response(status)
+        for header, value in (headers or {}).items():
+            request.send_header(header, value)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen to (default: 8000)")
+    parser.add_argument("--latency", type=float, default=0., help="Seconds added to every answer")
+    parser.add_argument("--rate-limit", dest="rate_limit", default=None,
+            help="Answer 429 beyond this rate, as requests/seconds (e.g. 15/5)")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0., help="Fraction of requests answered with a 503")
+    parser.add_argument("--miss-rate", dest="miss_rate", type=float, default=0., help="Fraction of keys not in the databases")
+    parser.add_argument("--num-authors", dest="num_authors", type=int, default=10, help="Number of authors of INSPIRE records")
+    args = parser.parse_args()
+
+    rate_limit = tuple(float(x) for x in args.rate_limit.split('/')) if args.rate_limit else None
+    mock = MockDatabases(port=args.port, latency=args.latency, rate_limit=rate_limit, error_rate=args.error_rate,
+                         miss_rate=args.miss_rate, num_authors=args.num_authors)
+    print("Serving ADS and INSPIRE stand-ins on", mock.url)
+    for variable, value in mock.environment().items():
+        print("export {}={}".format(variable, value))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
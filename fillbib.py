@@ -11,13 +11,16 @@ python fillbib.py <tex_file> <bib_file>. If <bib_file> is absent, it will try to
 
 '''
 from __future__ import absolute_import, print_function
-import argparse
-import sys, os, re, html
-import json
-
-import token
-import urllib.request
-import requests
+import argparse, functools, collections
+import sys, os, re, io
+import json, time, threading, contextlib, stat
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+# Most runs (e.g. filltex on a document whose citations did not change) download nothing, so the modules
+# needed to query the databases (http.client, sqlite3, concurrent.futures, ...) are only imported by the
+# functions which use them. This makes starting fillbib several times faster.
 
 # def ads_citation(c): # download single ADS citation
 #     #f= urllib.urlopen("http://adsabs.harvard.edu/cgi-bin/nph-bib_query?bibcode="+c+"&data_type=BIBTEX&db_key=AST&nocookieset=1")
@@ -34,6 +37,263 @@ import requests
 #     return bib
 
 
+class Tracer(object):
+    '''
+    Timing of the stages of a run (aux scan, bib scan, each query, journal names, ...).
+    When enabled, each stage is written as a JSON line with its name, start time, duration and
+    details such as number of keys, HTTP status, bytes and cache hits; `summary` prints a table
+    with the total time spent in each stage. Disabled by default, and then almost free.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.file = None
+        self.lock = threading.Lock()
+
+    def configure(self, tracefile=None, profile=False):
+        self.enabled = bool(tracefile or profile)
+        if tracefile:
+            self.file = open(tracefile, 'a')
+
+    @contextlib.contextmanager
+    def span(self, name, **details):
+        '''Time a block of code. Details can be added to the yielded dictionary while the block runs.'''
+        if not self.enabled:
+            yield details
+            return
+        start = time.time()
+        try:
+            yield details
+        finally:
+            self.record(name, start, time.time() - start, **details)
+
+    def record(self, name, start, duration, **details):
+        event = dict(name=name, ts=start, dur=duration, pid=os.getpid(), tid=threading.current_thread().name, **details)
+        with self.lock:
+            self.events.append(event)
+            if self.file is not None:
+                self.file.write(json.dumps(event) + '\n')
+                self.file.flush()
+
+    def summary(self, events=None, out=sys.stderr):
+        '''Print the number of calls and total, mean and maximum time of each stage.'''
+        stats = {}
+        for event in (self.events if events is None else events):
+            s = stats.setdefault(event['name'], [0, 0., 0.])
+            s[0] += 1
+            s[1] += event['dur']
+            s[2] = max(s[2], event['dur'])
+        out.write("{:<28} {:>7} {:>10} {:>10} {:>10}\n".format("stage", "calls", "total [s]", "mean [s]", "max [s]"))
+        for name, (n, total, longest) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            out.write("{:<28} {:>7} {:>10.3f} {:>10.3f} {:>10.3f}\n".format(name, n, total, total/n, longest))
+
+TRACE = Tracer()
+
+def traced(function):
+    '''Decorator: time every call of a function with TRACE, with the number of keys asked and found.'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not TRACE.enabled:
+            return function(*args, **kwargs)
+        with TRACE.span(function.__name__) as span:
+            if args and isinstance(args[0], (list, set, tuple)):
+                span['keys'] = len(args[0])
+            elif args and isinstance(args[0], str):
+                span['arg'] = args[0]
+            result = function(*args, **kwargs)
+            if isinstance(result, (dict, set)):
+                span['found'] = len(result)
+            elif isinstance(result, str):
+                span['found'] = 1
+            return result
+    return wrapper
+
+# Where the databases are. These can be changed to point to a local stand-in (see benchmarks/).
+ADS_API = os.environ.get('FILLBIB_ADS_API', 'https://api.adsabs.harvard.edu')
+ADS_UI = os.environ.get('FILLBIB_ADS_UI', 'https://ui.adsabs.harvard.edu')
+INSPIRE_API = os.environ.get('FILLBIB_INSPIRE_API', 'https://inspirehep.net')
+
+# Timeouts (seconds) to open a connection and to wait for an answer, and how many times a query is
+# attempted before giving up.
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+HTTP_RETRIES = 5
+# Longest we are willing to wait for a rate limit to reset before giving up (seconds)
+HTTP_MAX_WAIT = 120
+# Rate limits enforced by the client itself: (number of requests, period in seconds).
+# INSPIRE allows 15 requests every 5 seconds from the same IP.
+RATE_LIMITS = {'inspirehep.net': (15, 5.)}
+
+class FetchError(Exception):
+    '''A query could not be completed, even after retrying. This is not the same as a key not being found.'''
+    pass
+
+class RateLimiter(object):
+    '''
+    Schedule the requests to a single host: keep at most `limit` requests every `period` seconds,
+    and wait when the server says so (Retry-After, or ADS X-RateLimit-* headers).
+    '''
+
+    def __init__(self, limit=None, period=None):
+        self.limit = limit
+        self.period = period
+        self.recent = []
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                delay = self.blocked_until - now
+                if self.limit:
+                    self.recent = [t for t in self.recent if now - t < self.period]
+                    if len(self.recent) >= self.limit:
+                        delay = max(delay, self.recent[0] + self.period - now)
+                if delay <= 0:
+                    self.recent.append(now)
+                    return
+            if delay > HTTP_MAX_WAIT:
+                raise FetchError("rate limit exceeded, retry in {:.0f} seconds".format(delay))
+            time.sleep(delay)
+
+    def update(self, status, headers):
+        '''Read the rate limit information returned by the server.'''
+        with self.lock:
+            retry_after = headers.get('Retry-After')
+            if status == 429 and retry_after and retry_after.isdigit():
+                self.blocked_until = max(self.blocked_until, time.time() + int(retry_after))
+            remaining, reset = headers.get('X-RateLimit-Remaining'), headers.get('X-RateLimit-Reset')
+            if remaining is not None and reset is not None and remaining.isdigit() and int(remaining) == 0:
+                self.blocked_until = max(self.blocked_until, float(reset))
+
+class Transport(object):
+    '''
+    All HTTP queries go through here. Connections are kept alive and reused (one per host and per
+    thread), queries time out, and failed or throttled queries are retried with exponential backoff.
+    '''
+
+    def __init__(self):
+        self.local = threading.local()
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0, 'retries': 0}
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def limiter(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(*RATE_LIMITS.get(host, (None, None)))
+            return self.limiters[host]
+
+    def connection(self, scheme, host):
+        import http.client
+        conns = self.local.__dict__.setdefault('conns', {})
+        if (scheme, host) not in conns:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = cls(host, timeout=HTTP_CONNECT_TIMEOUT)
+            conn.connect()
+            conn.sock.settimeout(HTTP_READ_TIMEOUT)
+            conns[(scheme, host)] = conn
+        return conns[(scheme, host)]
+
+    def drop(self, scheme, host):
+        conn = self.local.__dict__.get('conns', {}).pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    def exchange(self, scheme, host, method, path, body, headers):
+        '''
+        Send a query and get the response. If the server has closed a kept-alive connection in the meantime,
+        the query is sent again straight away on a new one: this is not a failure, and is not delayed.
+        '''
+        import http.client
+        reused = (scheme, host) in self.local.__dict__.get('conns', {})
+        try:
+            conn = self.connection(scheme, host)
+            conn.request(method, path, body=body, headers=headers)
+            self.count('requests')
+            return conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            if not reused:
+                raise
+            self.drop(scheme, host)
+        conn = self.connection(scheme, host)
+        conn.request(method, path, body=body, headers=headers)
+        self.count('requests')
+        return conn.getresponse()
+
+    def request(self, method, url, body=None, headers=None):
+        '''
+        Returns the body of the answer (bytes), or None if the server answered 404.
+        Raises FetchError if the query keeps failing.
+        '''
+        import gzip, random, http.client, urllib.parse
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', 'filltex')
+        headers['Accept-Encoding'] = 'gzip'
+        error = None
+        for attempt in range(HTTP_RETRIES):
+            if attempt:
+                self.count('retries')
+                time.sleep(min(2**attempt, 30) * (0.5 + random.random()))
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            limiter = self.limiter(parts.netloc)
+            limiter.wait()
+            with TRACE.span("http " + method, host=parts.netloc, attempt=attempt) as span:
+                try:
+                    response = self.exchange(parts.scheme, parts.netloc, method, path, body, headers)
+                    data = response.read()
+                    self.count('bytes', len(data))
+                    span.update(status=response.status, bytes=len(data))
+                except (OSError, http.client.HTTPException) as e:
+                    span.update(error=str(e))
+                    self.drop(parts.scheme, parts.netloc)
+                    error = e
+                    continue
+            if response.getheader('Connection', '').lower() == 'close':
+                self.drop(parts.scheme, parts.netloc)
+
+            limiter.update(response.status, response.headers)
+            if response.getheader('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status == 404:
+                return None
+            if response.status == 429 or response.status >= 500:
+                error = "HTTP {} from {}".format(response.status, parts.netloc)
+                continue
+            if response.status >= 400:
+                raise FetchError("HTTP {} from {}".format(response.status, parts.netloc))
+            return data
+
+        raise FetchError("{} failed: {}".format(url, error))
+
+transport = Transport()
+
+def http_get(url, headers=None):
+    '''GET a url with the shared transport. Returns the body (bytes), or None if not found.'''
+    return transport.request('GET', url, headers=headers)
+
+def http_post_json(url, data, headers=None):
+    '''POST a JSON document with the shared transport. Returns the decoded JSON answer, or None if not found.'''
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    answer = transport.request('POST', url, body=json.dumps(data).encode(), headers=headers)
+    return None if answer is None else json.loads(answer)
+
+
+@traced
 def ads_citation(c): 
     """
     Download a single ADS citation. Uses ADS_TOKEN if available; otherwise falls back to UI scrape.
@@ -42,27 +302,282 @@ def ads_citation(c):
         c (str): ADS bibcode
 
     Returns:
-        str: BibTeX citation
+        str: BibTeX citation, or None if not found
     """
+    import html, urllib.parse
     token = os.environ.get('ADS_TOKEN')
     if token:
         # Use ADS API with token
-
-        results = requests.get(f"https://api.adsabs.harvard.edu/v1/export/bibtex/{c}", headers={'Authorization': 'Bearer ' + token})
-        bib = results.text
+        bib = http_get(ADS_API + "/v1/export/bibtex/" + urllib.parse.quote(c),
+                headers={'Authorization': 'Bearer ' + token})
+        if bib is None:
+            return None
+        bib = bib.decode()
 
     else:
         print('No ADS_TOKEN found in environment; falling back to UI scrape.', file=sys.stderr)
         # Fall back to UI scrape
-        url = f"https://ui.adsabs.harvard.edu/abs/{c}/exportcitation"
-        with urllib.request.urlopen(url) as f:
-            bib = f.read().decode()
-            # Extract the BibTeX entry
-            bib = "@"+list(filter(lambda x:'adsnote' in x, bib.split("@")))[0].split("</textarea>")[0]
-            bib = html.unescape(bib)
+        bib = http_get(ADS_UI + "/abs/" + urllib.parse.quote(c) + "/exportcitation")
+        if bib is None:
+            return None
+        # Extract the BibTeX entry
+        bib = list(filter(lambda x:'adsnote' in x, bib.decode().split("@")))
+        if not bib:
+            return None
+        bib = html.unescape("@"+bib[0].split("</textarea>")[0])
 
     return bib
 
+# Start of a BibTeX record: @type{ or @type(
+BIBTEX_START = re.compile(r'\s*@\s*([A-Za-z]+)\s*([{(])')
+
+def iter_bibtex(lines):
+    '''
+    Stream the records of a BibTeX file (or any iterable of lines), one at a time.
+    Yields (key, record) pairs. Each record carries along the text that follows it, up to the next
+    record, so that joining all records gives back the original file. The key is None for @string,
+    @preamble and @comment, and for text before the first record.
+    '''
+    record, key, header, depth = [], None, None, 0
+    opening, closing = '{', '}'
+    for line in lines:
+        while line:
+            # A new record starts outside other records. Unbalanced braces in a broken record should not
+            # swallow the rest of the file, so an @ in the first column always starts a new record.
+            m = BIBTEX_START.match(line) if depth <= 0 or line.startswith('@') else None
+            if m:
+                if record:
+                    yield key, ''.join(record)
+                record, key = [], None
+                opening, closing = (m.group(2), '}' if m.group(2) == '{' else ')')
+                rest = line[m.end():]
+                depth = 1
+                header = '' if m.group(1).lower() not in ('string', 'preamble', 'comment') else None
+            else:
+                rest = line
+            segment, line = line, ''
+            if depth > 0:
+                before = depth
+                depth += rest.count(opening) - rest.count(closing)
+                if '@' in rest:
+                    # Another record may start on the same line, after this one is closed
+                    for i, ch in enumerate(rest):
+                        before += (ch == opening) - (ch == closing)
+                        if before == 0:
+                            if BIBTEX_START.match(rest, i+1):
+                                cut = len(segment) - len(rest) + i + 1
+                                segment, line, rest = segment[:cut], segment[cut:], rest[:i+1]
+                                depth = 0
+                            break
+            record.append(segment)
+            if header is not None:
+                header += rest
+                if ',' in header or depth <= 0: # The key may be on a line of its own
+                    key = header.split(',')[0].strip().rstrip(closing).strip()
+                    header = None
+    if record:
+        yield key, ''.join(record)
+
+def split_bibtex(text):
+    '''Split a string with several BibTeX records into a list of (key, record) pairs.'''
+    return [(key, bib) for key, bib in iter_bibtex(text.splitlines(True)) if key]
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='w', **kwargs):
+    '''
+    Open a file for writing through a temporary file in the same directory, which replaces the original
+    only once everything has been written and flushed to disk: an interrupted run never leaves a
+    half-written file behind. The permissions of the original file are kept. Other arguments are
+    passed to open.
+    '''
+    import tempfile
+    filename = os.path.realpath(filename) # Replace the file a symbolic link points to, not the link
+    directory, name = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filename):
+            os.chmod(tmp, stat.S_IMODE(os.stat(filename).st_mode))
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class BibEntry(object):
+    '''
+    Where a BibTeX record is in a file: its key and type, and the position and size (in bytes) of its text,
+    which is read only when needed. Even the entries of a bib file with hundreds of thousands of records can
+    then be kept in memory (e.g. to sort them) at the cost of a few numbers each.
+    '''
+    __slots__ = ('key', 'type', 'start', 'size')
+
+    def __init__(self, key, type, start, size):
+        self.key = key
+        self.type = type
+        self.start = start
+        self.size = size
+
+    def read(self, f):
+        '''The text of the record, from the bib file opened in binary mode.'''
+        f.seek(self.start)
+        return f.read(self.size).decode('utf-8', 'surrogateescape')
+
+def bib_entries(f):
+    '''
+    Stream the records of a bib file opened in binary mode, as (BibEntry, text) pairs; only one record is
+    in memory at a time. The type is None for text before the first record.
+    '''
+    start = f.tell()
+    lines = io.TextIOWrapper(f, encoding='utf-8', errors='surrogateescape', newline='')
+    try:
+        for key, record in iter_bibtex(lines):
+            m = BIBTEX_START.match(record)
+            size = len(record.encode('utf-8', 'surrogateescape'))
+            yield BibEntry(key, m.group(1).lower() if m else None, start, size), record
+            start += size
+    finally:
+        lines.detach()
+
+def bib_index_file(bibfile):
+    '''Sidecar file where the keys of a BibTeX file are saved.'''
+    directory, name = os.path.split(bibfile)
+    return os.path.join(directory, '.' + name + '.keys')
+
+# Keys of the bib files already read in this session: {path: (size, mtime, keys)}
+BIB_INDEX = {}
+
+def save_bib_index(bibfile, keys):
+    '''Save the keys of a BibTeX file, together with its size and modification time.'''
+    st = os.stat(bibfile)
+    BIB_INDEX[os.path.abspath(bibfile)] = (st.st_size, st.st_mtime_ns, set(keys))
+    try:
+        with open(bib_index_file(bibfile), 'w') as f:
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime_ns, 'keys': sorted(keys)}, f)
+    except OSError: # Not being able to save the index only makes the next run slower
+        pass
+
+@traced
+def bib_keys(bibfile):
+    '''
+    Set of keys in a BibTeX file. The file is parsed only if it changed since the last time
+    (according to its size and modification time); otherwise the keys come from the sidecar index.
+    '''
+    if not os.path.isfile(bibfile):
+        return set()
+    st = os.stat(bibfile)
+    memo = BIB_INDEX.get(os.path.abspath(bibfile))
+    if memo is not None and memo[:2] == (st.st_size, st.st_mtime_ns):
+        return set(memo[2])
+    try:
+        with open(bib_index_file(bibfile), 'r') as f:
+            index = json.load(f)
+        if index['size'] == st.st_size and index['mtime'] == st.st_mtime_ns:
+            BIB_INDEX[os.path.abspath(bibfile)] = (st.st_size, st.st_mtime_ns, set(index['keys']))
+            return set(index['keys'])
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(bibfile, 'r') as f:
+        keys = set(key for key, bib in iter_bibtex(f) if key)
+    save_bib_index(bibfile, keys)
+    return keys
+
+def arxiv_id(c):
+    '''arXiv identifier (without dots) of an ADS preprint bibcode such as 2016arXiv160203837T, or None.'''
+    if c[4:9] == 'arXiv':
+        return c[9:18].replace('.', '')
+    return None
+
+@traced
+def ads_citations(keys, batch=500):
+    """
+    Download many ADS citations with as few queries as possible. Requires ADS_TOKEN; otherwise the
+    citations are downloaded one by one with ads_citation.
+
+    Parameters:
+        keys (list): ADS bibcodes
+        batch (int): maximum number of bibcodes in a single query
+
+    Returns:
+        dict: {bibcode: BibTeX citation}, only for the bibcodes which were found
+    """
+    token = os.environ.get('ADS_TOKEN')
+    if not token:
+        found = {c: ads_citation(c) for c in keys}
+        return {c: bib for c, bib in found.items() if bib is not None}
+
+    found = {}
+    for i in range(0, len(keys), batch):
+        chunk = keys[i:i+batch]
+        results = http_post_json(ADS_API + "/v1/export/bibtex", {'bibcode': chunk},
+            headers={'Authorization': 'Bearer ' + token})
+        if results is None: # None of the bibcodes is on ADS
+            continue
+        entries = split_bibtex(results['export'])
+
+        # ADS returns the published record for preprints, which has a different key. Match those back
+        # to what was asked for using the arXiv number. The same record may also be the answer to a
+        # published key of the chunk, so all of them are matched, not only the leftovers.
+        wanted = set(chunk)
+        leftovers = False
+        for cfound, bib in entries:
+            if cfound in wanted:
+                found[cfound] = bib
+            else:
+                leftovers = True
+        preprints = {}
+        for c in chunk:
+            if c not in found and arxiv_id(c) is not None:
+                preprints.setdefault(arxiv_id(c), []).append(c)
+        for cfound, bib in entries:
+            m = re.search(r'eprint\s*=\s*[{"]([^}"]+)', bib)
+            if m:
+                for c in preprints.pop(m.group(1).replace('.', ''), []):
+                    found[c] = bib
+
+        # If something is still unmatched, ask for the missing keys one at a time. This only costs
+        # extra queries when ADS returned records that could not be matched, or for preprints.
+        for c in chunk:
+            if c not in found and (leftovers or arxiv_id(c) is not None):
+                bib = ads_citation(c)
+                if bib is not None:
+                    found[c] = bib
+
+    return found
+
+def ads_identifier(c):
+    '''
+    Download the ADS record of a DOI or an arXiv number. The entry gets `c` as its key.
+    Returns the BibTeX citation, or None if not found.
+    '''
+    import urllib.parse
+    token = os.environ.get('ADS_TOKEN')
+    if token:
+        identifier = re.sub(r'^doi:', '', c, flags=re.IGNORECASE)
+        answer = http_get(ADS_API + '/v1/search/query?fl=bibcode&rows=1&q=' + urllib.parse.quote('identifier:"{}"'.format(identifier)),
+                headers={'Authorization': 'Bearer ' + token})
+        docs = json.loads(answer)['response']['docs'] if answer is not None else []
+        bib = ads_citation(docs[0]['bibcode']) if docs else None
+    else: # The ADS abstract pages also accept DOIs and arXiv numbers
+        bib = ads_citation(c)
+    if bib is None:
+        return None
+    return bib.split("{")[0]+"{"+c+","+",".join(bib.split(",")[1:])
+
+# Metadata needed to generate a BibTeX entry from an INSPIRE record. Asking only for these fields
+# avoids downloading the full record, which for large collaborations lists thousands of authors with
+# affiliations and identifiers.
+INSPIRE_FIELDS = ",".join(["texkeys", "document_type", "authors.full_name", "collaborations",
+    "titles", "arxiv_eprints", "dois", "publication_info", "preprint_date"])
+
+@traced
 def inspire_citation(key,
         generate=False,
         max_num_authors=None,
@@ -81,19 +596,93 @@ def inspire_citation(key,
     * journal_arXiv_fallback
         use arXiv:eprint as the journal field if no journal is found
     """
-    request = 'https://inspirehep.net/api/literature?q=' + key
-    data = json.loads(urllib.urlopen(request).read())
+    import urllib.parse
+    fields = INSPIRE_FIELDS if generate else "texkeys"
+    request = INSPIRE_API + '/api/literature?q=' + urllib.parse.quote(key) + '&fields=' + fields
+    data = json.loads(http_get(request))
     if data['hits']['total'] != 1:
         return None
     if not generate:
-        bib = urllib.request.urlopen(data['hits']['hits'][0]['links']['bibtex']).read()
+        bib = http_get(data['hits']['hits'][0]['links']['bibtex'])
+        if bib is None:
+            return None
         inspire_key = data['hits']['hits'][0]['metadata']['texkeys'][0]
-        if sys.version_info.major >= 3:
-            return bib.decode().replace(inspire_key, key)
-        else:
-            return bib.replace(inspire_key, key)
+        return bib.decode().replace(inspire_key, key)
     metadata = data['hits']['hits'][0]['metadata']
 
+    return inspire_bibtex(key, metadata,
+        max_num_authors=max_num_authors,
+        num_authors_short=num_authors_short,
+        journal_arXiv_fallback=journal_arXiv_fallback)
+
+@traced
+def inspire_citations(keys,
+        generate=False,
+        max_num_authors=None,
+        num_authors_short=None,
+        journal_arXiv_fallback=False,
+        batch=50):
+    """
+    Download many INSPIRE citations, asking for up to `batch` texkeys in a single query.
+    Options are the same as for inspire_citation. Keys which cannot be matched to the returned
+    records (e.g. they are not the main texkey of the record) are looked up one by one.
+    Returns a dictionary {key: bibtex}, only for the keys which were found.
+    """
+    import urllib.parse
+    found = {}
+    for i in range(0, len(keys), batch):
+        chunk = keys[i:i+batch]
+        wanted = set(chunk)
+        query = urllib.parse.quote(" or ".join('texkeys:"{}"'.format(c) for c in chunk))
+        leftovers = False
+
+        if not generate:
+            # The BibTeX format gives all records in a single text; records are keyed by their main texkey
+            page = 1
+            while True:
+                request = INSPIRE_API + '/api/literature?q={}&format=bibtex&size={}&page={}'.format(query, batch, page)
+                entries = split_bibtex((http_get(request) or b'').decode())
+                for cfound, bib in entries:
+                    if cfound in wanted:
+                        found[cfound] = bib
+                    else:
+                        leftovers = True
+                if len(entries) < batch:
+                    break
+                page += 1
+        else:
+            request = INSPIRE_API + '/api/literature?q={}&fields={}&size={}'.format(query, INSPIRE_FIELDS, batch)
+            while request:
+                data = json.loads(http_get(request))
+                for hit in data['hits']['hits']:
+                    for c in wanted.intersection(hit['metadata'].get('texkeys', [])):
+                        found[c] = inspire_bibtex(c, hit['metadata'],
+                            max_num_authors=max_num_authors,
+                            num_authors_short=num_authors_short,
+                            journal_arXiv_fallback=journal_arXiv_fallback)
+                request = data.get('links', {}).get('next')
+
+        if leftovers:
+            for c in chunk:
+                if c not in found:
+                    bib = inspire_citation(c,
+                        generate=generate,
+                        max_num_authors=max_num_authors,
+                        num_authors_short=num_authors_short,
+                        journal_arXiv_fallback=journal_arXiv_fallback)
+                    if bib is not None:
+                        found[c] = bib
+
+    return found
+
+def inspire_bibtex(key, metadata,
+        max_num_authors=None,
+        num_authors_short=None,
+        journal_arXiv_fallback=False):
+    """
+    Format the metadata of an INSPIRE record into a BibTeX entry with the given key.
+    Options are the same as for inspire_citation.
+    """
     doctype = metadata["document_type"][0]
 
     # BibTeX entry as a dictionary
@@ -182,282 +771,1399 @@ def inspire_citation(key,
 def test_ads(): # test single ADS web scraping (both published articles and preprints)
     test_key = ["2016PhRvL.116f1102A","2016arXiv160203837T"]
     known_output= '@ARTICLE{2016PhRvL.116f1102A,\n   author = {{Abbott}, B.~P. and {Abbott}, R. and {Abbott}, T.~D. and {Abernathy}, M.~R. and \n\t{Acernese}, F. and {Ackley}, K. and {Adams}, C. and {Adams}, T. and \n\t{Addesso}, P. and {Adhikari}, R.~X. and et al.},\n    title = "{Observation of Gravitational Waves from a Binary Black Hole Merger}",\n  journal = {Physical Review Letters},\narchivePrefix = "arXiv",\n   eprint = {1602.03837},\n primaryClass = "gr-qc",\n     year = 2016,\n    month = feb,\n   volume = 116,\n   number = 6,\n      eid = {061102},\n    pages = {061102},\n      doi = {10.1103/PhysRevLett.116.061102},\n   adsurl = {http://adsabs.harvard.edu/abs/2016PhRvL.116f1102A},\n  adsnote = {Provided by the SAO/NASA Astrophysics Data System}\n}\n\n'
-    assert [ads_citation(tk) == known_output for tk in test_key]
+    assert all([ads_citation(tk) == known_output for tk in test_key])
 
 def test_inspire(): # test single INSPIRE web scraping
     test_key = "Abbott:2016blz"
     known_output = '@article{Abbott:2016blz,\n    author = "Abbott, B.P. and Abbott, R. and Abbott, T.D. and Abernathy, M.R. and Acernese, F. and others",\n    collaboration = "LIGO Scientific, Virgo",\n    title = "{Observation of Gravitational Waves from a Binary Black Hole Merger}",\n    eprint = "1602.03837",\n    archivePrefix = "arXiv",\n    primaryClass = "gr-qc",\n    doi = "10.1103/PhysRevLett.116.061102",\n    journal = "Phys.Rev.Lett.",\n    volume = "116",\n    number = "6",\n    year = "2016"\n}'
     assert inspire_citation(test_key, generate=True, max_num_authors=5) == known_output
 
-def fillbib_tex(args):
+def test_bibtex_parser(): # offline: records are split correctly, and joining them gives back the file
+    text = ('% preamble text\n@string{apj = "Astrophys. J."}\n'
+            '@article{a,\n  title = {{Nested} braces},\n  email = {x@y.org}}\n\n'
+            '@ARTICLE(\n  b,\n  title = "(c)")\n'
+            '@misc{c, title={x}} @misc{d, title={y}}\n'
+            '@comment{e, not a record}\n')
+    records = list(iter_bibtex(text.splitlines(True)))
+    assert [key for key, record in records] == [None, None, 'a', 'b', 'c', 'd', None]
+    assert ''.join(record for key, record in records) == text
+
+def test_bib_index(): # offline: the sidecar index is used only while the bib file is unchanged
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        bibfile = os.path.join(directory, 'refs.bib')
+        with open(bibfile, 'w') as f:
+            f.write('@misc{a,\n}\n')
+        assert bib_keys(bibfile) == {'a'}
+        assert os.path.isfile(bib_index_file(bibfile))
+        BIB_INDEX.clear()
+        assert bib_keys(bibfile) == {'a'}
+        with open(bibfile, 'a') as f:
+            f.write('@misc{b,\n}\n')
+        assert bib_keys(bibfile) == {'a', 'b'}
+        BIB_INDEX.clear()
+        assert bib_keys(bibfile) == {'a', 'b'}
+
+def test_replace_keys(): # offline: only whole keys are replaced
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        texfile = os.path.join(directory, 'paper.tex')
+        with open(texfile, 'w') as f:
+            f.write('\\cite{2016arXiv160203837T}, \\cite{x, 2016arXiv160203837T,y} \\cite{2016arXiv160203837Tb}\n')
+        assert replace_keys([texfile], {'2016arXiv160203837T': '2016PhRvL.116f1102A'}) == [texfile]
+        with open(texfile, 'r') as f:
+            assert f.read() == ('\\cite{2016PhRvL.116f1102A}, \\cite{x, 2016PhRvL.116f1102A,y} '
+                                '\\cite{2016arXiv160203837Tb}\n')
+        assert replace_keys([texfile], {'2016arXiv160203837T': '2016PhRvL.116f1102A'}) == []
+
+def test_parse_aux(): # offline: citations of \include'd files are read, and the revtex *Notes.bib is left out
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'paper.aux'), 'w') as f:
+            f.write('\\citation{a,b}\n\\bibdata{paperNotes,refs}\n\\@input{chapter.aux}\n')
+        with open(os.path.join(directory, 'chapter.aux'), 'w') as f:
+            f.write('\\citation{c}\n')
+        assert parse_aux(os.path.join(directory, 'paper.aux')) == ({'a', 'b', 'c'}, ['refs'])
+
+def test_tex_citations(): # offline: citations are read from the tex file, and only from citation commands
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        texfile = os.path.join(directory, 'paper.tex')
+        with open(texfile, 'w') as f:
+            f.write('\\citestyle{aa} \\cite{a} \\citep[see][]{b, c} % \\cite{x}\n'
+                    '\\Citeauthor*{d} \\cites[see][]{e}{f} \\citetext{not a key}\n\\bibliography{refs}\n')
+        assert tex_citations(texfile) == ({'a', 'b', 'c', 'd', 'e', 'f'}, [os.path.join(directory, 'refs.bib')])
+
+def test_watcher_polling(): # offline: without inotify, a save is reported once
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        texfile = os.path.join(directory, 'paper.tex')
+        with open(texfile, 'w') as f:
+            f.write('a')
+        watcher = Watcher(debounce=0.1)
+        watcher.inotify = None
+        watcher.set_files([texfile])
+        def save():
+            with open(texfile, 'a') as f:
+                f.write('b')
+        threading.Timer(0.2, save).start()
+        assert watcher.wait() == {os.path.abspath(texfile)}
+
+def test_watcher_during_build(): # offline: a file saved while the document was being built is reported
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        texfile = os.path.join(directory, 'paper.tex')
+        with open(texfile, 'w') as f:
+            f.write('a')
+        times = {os.path.abspath(texfile): Watcher.mtime(texfile) - 1}
+        watcher = Watcher(debounce=0.1)
+        watcher.set_files([texfile], times)
+        assert watcher.wait() == {os.path.abspath(texfile)}
+
+def backend(c):
+    '''Database to query for a given key: ADS bibcodes start with the year, INSPIRE texkeys with a name.'''
+    return "INSPIRE" if c[0].isalpha() else "ADS"
+
+# Keys which are neither ADS bibcodes nor INSPIRE texkeys, and could be in either database: DOIs and arXiv numbers
+IDENTIFIER = re.compile(r'(?:doi:)?10\.\d{4,9}/\S+$|(?:arXiv:)?(?:\d{4}\.\d{4,5}|[a-z-]+(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?$', re.IGNORECASE)
+
+def ambiguous(c):
+    '''Whether the database of a key cannot be told from its shape.'''
+    return IDENTIFIER.match(c) is not None
+
+# How long downloaded entries are trusted, in seconds. Keys which were not found are retried sooner,
+# as they may just be too recent.
+CACHE_TTL = {"ADS": 30*86400, "INSPIRE": 30*86400}
+CACHE_TTL_MISS = 86400
+CACHE_MAX_ENTRIES = 100000
+
+def cache_dir():
+    '''Where filltex keeps its files shared between documents (FILLTEX_CACHE, or the user cache directory).'''
+    return os.environ.get('FILLTEX_CACHE') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'filltex')
+
+class CitationCache(object):
+    '''
+    Downloaded BibTeX entries, stored in a SQLite database shared by all your documents.
+    Entries are stored per database and per `variant` (the options used to generate them); a
+    missing entry is stored as None, so that keys which could not be found are not asked again at every compile.
+    '''
 
-    if args.bibtex is None:     # Get the name of the bibfile from the aux file
-        basename = args.texfile[0].split('.tex')[0]
-        auxfile = basename + '.aux'
-        for line in open(auxfile,'r'):
-            m = re.search(r'\\bibdata\{(.*)\}',line)   # match \citation{...}, collect the ... note that we escape \, {, and }
-            if m:
-                bibfile = list(filter(lambda x:x!=basename+'Notes', m.group(1).split(',')))[0]  # Remove that annyoing feature of revtex which creates a *Notes.bib bibfile. Note this is not solid if you want to handle multiple bib files.
-        bibfile = bibfile + '.bib'
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES):
+        if path is None:
+            path = os.path.join(cache_dir(), 'citations.sqlite')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        import sqlite3
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("CREATE TABLE IF NOT EXISTS citations (backend TEXT, variant TEXT, key TEXT, "
+                        "bibtex TEXT, fetched REAL, PRIMARY KEY (backend, variant, key))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS citations_fetched ON citations (fetched)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, backend TEXT, resolved REAL)")
+
+    def get(self, backend, variant, keys):
+        '''Returns a dictionary {key: bibtex or None} with the keys whose entry has not expired.'''
+        now = time.time()
+        found = {}
+        for key in keys:
+            row = self.db.execute("SELECT bibtex, fetched FROM citations WHERE backend=? AND variant=? AND key=?",
+                                  (backend, variant, key)).fetchone()
+            if row is not None:
+                bib, fetched = row
+                if now - fetched < (CACHE_TTL_MISS if bib is None else CACHE_TTL[backend]):
+                    found[key] = bib
+        return found
+
+    def put(self, backend, variant, found):
+        '''Store a dictionary {key: bibtex or None}, then drop the oldest entries if the cache is too large.'''
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO citations VALUES (?, ?, ?, ?, ?)",
+                                [(backend, variant, key, bib, now) for key, bib in found.items()])
+            self.db.execute("DELETE FROM citations WHERE rowid IN (SELECT rowid FROM citations "
+                            "ORDER BY fetched DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def routes(self, keys):
+        '''The database which answered for the keys that were looked up in both: {key: backend}.'''
+        found = {}
+        for key in keys:
+            row = self.db.execute("SELECT backend FROM routes WHERE key=?", (key,)).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        return found
+
+    def put_route(self, key, backend):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?)", (key, backend, time.time()))
+
+    def close(self):
+        self.db.close()
+
+def cache_variant(c, args, database=None):
+    '''The options which change what an entry looks like: only those of generated INSPIRE entries.'''
+    if (database or backend(c)) == "INSPIRE" and args.generate:
+        return "generate:{}:{}:{}".format(args.max_num_authors, args.num_authors_short, args.journal_arXiv_fallback)
+    return ""
+
+def fetch_ads(keys, args):
+    '''Query ADS for a group of keys. Returns a dictionary {key: bibtex}, or None if the query failed.'''
+    try:
+        return ads_citations(keys, batch=args.ads_batch)
+    except Exception as e:
+        sys.stderr.write("ADS query failed for {} keys: {}\n".format(len(keys), e))
+        return None
 
-    else:    # Bibfile specified from argv
-        basename = args.texfile[0].split('.tex')[0]
-        auxfile = basename + '.aux'
-        bibfile = args.bibtex.split('.bib')[0] + '.bib'
+def fetch_inspire(keys, args):
+    '''Query INSPIRE for a group of keys. Returns a dictionary {key: bibtex}, or None if the query failed.'''
+    try:
+        return inspire_citations(keys,
+                generate=args.generate,
+                max_num_authors=args.max_num_authors,
+                num_authors_short=args.num_authors_short,
+                journal_arXiv_fallback=args.journal_arXiv_fallback,
+                batch=args.inspire_batch)
+    except Exception as e:
+        sys.stderr.write("INSPIRE query failed for {} keys: {}\n".format(len(keys), e))
+        return None
 
-    if args.updatepublished:
-        with open(basename+".tex", 'r') as texfile:
-            texdata = texfile.read()
+def resolve(database, c, args):
+    '''Look up a single key of any kind (bibcode, texkey, DOI, arXiv number) in one database.'''
+    if database == "ADS":
+        return ads_identifier(c) if ambiguous(c) else ads_citation(c)
+    return inspire_citation(c,
+            generate=args.generate,
+            max_num_authors=args.max_num_authors,
+            num_authors_short=args.num_authors_short,
+            journal_arXiv_fallback=args.journal_arXiv_fallback)
+
+# With --hedge, the keys of a failed query are looked up again one by one in both databases, but only
+# for small queries: when a large batch fails, the database is most likely down, and hundreds of single
+# queries (each retried with backoff) would only make things worse
+HEDGE_FAILED_MAX = 10
+
+def hedged_citation(c, args, databases=("ADS", "INSPIRE")):
+    '''
+    Ask several databases for the same key at the same time, and take the first answer which is an entry.
+    The other queries are cancelled if they have not started yet, and otherwise their answer is ignored.
+    Returns (database, bibtex), or (None, None) if no database has the key. Raises FetchError if some query failed
+    and no other database had the key: the key may well be in the database which could not answer.
+    '''
+    from concurrent.futures import wait, FIRST_COMPLETED
+    pending = {worker_pool(database, getattr(args, database.lower() + '_workers')).submit(resolve, database, c, args): database
+               for database in databases}
+    errors = []
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for job in done:
+                database = pending.pop(job)
+                try:
+                    bib = job.result()
+                except Exception as e:
+                    errors.append("{}: {}".format(database, e))
+                    continue
+                if bib is not None:
+                    return database, bib
+    finally:
+        for job in pending:
+            job.cancel()
+    if errors:
+        raise FetchError("; ".join(errors))
+    return None, None
+
+# Worker pools, created on first use and kept for the whole session, so that in watch mode the
+# connections held by their threads stay open from one build to the next
+POOLS = {}
+
+def worker_pool(name, workers):
+    '''The pool of workers querying a database.'''
+    if name not in POOLS:
+        from concurrent.futures import ThreadPoolExecutor
+        POOLS[name] = ThreadPoolExecutor(max_workers=max(1, workers))
+    return POOLS[name]
+
+# What fetch_many (and the command line) yields for each key. status is "found" (downloaded), "cached" (from the
+# local cache), "missing" (not in the databases) or "failed" (the query failed, or was not made with offline).
+# latency is the time in seconds the query took, 0 for entries from the cache.
+Result = collections.namedtuple('Result', ['key', 'backend', 'bibtex', 'status', 'latency'])
+
+def iter_citations(keys, args):
+    '''
+    Query ADS and INSPIRE for many keys at once, yielding a Result for each key as soon as its query completes.
+    Each database gets its own pool of workers, so that a slow database does not hold up the other one and
+    each can be kept within its own limits. Keys are sent in batches of args.inspire_batch texkeys per INSPIRE
+    query and, with an ADS token, of args.ads_batch bibcodes per ADS query.
+    The local cache is looked up first (unless args.refresh), and nothing is downloaded if args.offline.
+    With args.hedge, DOIs, arXiv numbers and keys which were not found are looked up in both databases at
+    once (see hedged_citation), and the database which answered is remembered in the cache.
+    '''
+    from concurrent.futures import wait, FIRST_COMPLETED
+    keys = [c for c in dict.fromkeys(keys) if c] # Remove repetitions, keep the order
+
+    cache = None if args.no_cache else CitationCache()
+    try:
+        found = {}
+        routes = {}
+        if cache is not None and args.hedge:
+            routes = cache.routes(keys)
+        if cache is not None and not args.refresh:
+            with TRACE.span("cache lookup", keys=len(keys)) as span:
+                for c in keys:
+                    database = routes.get(c, backend(c))
+                    found.update(cache.get(database, cache_variant(c, args, database), [c]))
+                span.update(hits=len(found), misses=len(keys)-len(found))
+        for c in keys:
+            if c in found:
+                yield Result(c, routes.get(c, backend(c)), found[c], "missing" if found[c] is None else "cached", 0.)
+        if args.offline: # Not looked for, rather than not found
+            for c in keys:
+                if c not in found:
+                    yield Result(c, backend(c), None, "failed", 0.)
+            return
+
+        # With args.hedge, DOIs and arXiv numbers go straight to both databases
+        hedged = [c for c in keys if args.hedge and c not in found and (ambiguous(c) or c in routes)]
+        ads = [c for c in keys if backend(c) == "ADS" and c not in found and c not in hedged]
+        inspire = [c for c in keys if backend(c) == "INSPIRE" and c not in found and c not in hedged]
+
+        if os.environ.get('ADS_TOKEN'):
+            ads_groups = [ads[i:i+args.ads_batch] for i in range(0, len(ads), args.ads_batch)]
+        else:
+            ads_groups = [[c] for c in ads]
+        inspire_groups = [inspire[i:i+args.inspire_batch] for i in range(0, len(inspire), args.inspire_batch)]
+
+        # {job: (group of keys, hedged or not, when it was submitted)}
+        jobs = {}
+        def hedge(c, databases=("ADS", "INSPIRE")):
+            job = worker_pool("hedge", args.ads_workers + args.inspire_workers).submit(
+                    hedged_citation, c, args, (routes[c],) if c in routes else databases)
+            jobs[job] = ([c], True, time.time())
+
+        for group in ads_groups:
+            jobs[worker_pool("ADS", args.ads_workers).submit(fetch_ads, group, args)] = (group, False, time.time())
+        for group in inspire_groups:
+            jobs[worker_pool("INSPIRE", args.inspire_workers).submit(fetch_inspire, group, args)] = (group, False, time.time())
+        for c in hedged:
+            hedge(c)
+
+        while jobs:
+            done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for job in done:
+                group, hedging, submitted = jobs.pop(job)
+                latency = time.time() - submitted
+
+                if hedging:
+                    c = group[0]
+                    try:
+                        database, bib = job.result()
+                    except FetchError as e:
+                        sys.stderr.write("Query failed for {}: {}\n".format(c, e))
+                        yield Result(c, backend(c), None, "failed", latency)
+                        continue
+                    if cache is not None:
+                        cache.put(database or backend(c), cache_variant(c, args, database), {c: bib})
+                        if database is not None:
+                            cache.put_route(c, database)
+                    yield Result(c, database or backend(c), bib, "missing" if bib is None else "found", latency)
+                    continue
+
+                result = job.result()
+                if result is None: # The query failed: do not remember these keys as missing
+                    for c in group:
+                        if args.hedge and len(group) <= HEDGE_FAILED_MAX:
+                            hedge(c)
+                        else:
+                            yield Result(c, backend(c), None, "failed", latency)
+                    continue
+                fetched = {c: result.get(c) for c in group}
+                if cache is not None: # With args.hedge, the keys not found are remembered once the other database answered
+                    cache.put(backend(group[0]), cache_variant(group[0], args),
+                              {c: bib for c, bib in fetched.items() if bib is not None or not args.hedge})
+                for c in group:
+                    if fetched[c] is None and args.hedge: # Maybe it is in the other database
+                        hedge(c, tuple(database for database in ("ADS", "INSPIRE") if database != backend(c)))
+                    else:
+                        yield Result(c, backend(c), fetched[c], "missing" if fetched[c] is None else "found", latency)
+    finally:
+        if cache is not None:
+            cache.close()
+
+def fetch_citations(keys, args, failed=None):
+    '''
+    Query ADS and INSPIRE for many keys at once (see iter_citations).
+    Returns a dictionary {key: bibtex}, with None for keys that were not found. If a set `failed` is
+    given, the keys whose query failed (rather than not being found) are added to it.
+    '''
+    found = {}
+    for result in iter_citations(keys, args):
+        found[result.key] = result.bibtex
+        if result.status == "failed" and failed is not None:
+            failed.add(result.key)
+    return {c: found.get(c) for c in dict.fromkeys(keys) if c}
+
+# Default options of fetch_many, the same as on the command line
+FETCH_OPTIONS = {'generate': False, 'max_num_authors': None, 'num_authors_short': None, 'journal_arXiv_fallback': False,
+                 'ads_workers': 4, 'inspire_workers': 2, 'ads_batch': 500, 'inspire_batch': 50,
+                 'offline': False, 'refresh': False, 'cache': True, 'hedge': False}
+
+def fetch_options(**options):
+    '''The options of fetch_many, as the arguments object used by the rest of fillbib.'''
+    unknown = set(options).difference(FETCH_OPTIONS)
+    if unknown:
+        raise TypeError("Unknown options: " + ", ".join(sorted(unknown)))
+    options = dict(FETCH_OPTIONS, **options)
+    options['no_cache'] = not options.pop('cache')
+    return argparse.Namespace(**options)
+
+def fetch_many(keys, chunk=1000, **options):
+    '''
+    Download the BibTeX entries of many ADS and INSPIRE keys, for use from other Python code.
+    Yields a Result(key, backend, bibtex, status, latency) for each key, as soon as it is available (so not
+    in the order of `keys`). Each key is looked up once, even if it is given several times.
 
-    # Get all citations from aux file. Citations will look like \citation{2004PhRvD..69j4017P,2004PhRvD..69j4017P}
-    cites = set() # use a set (no repetitions)
+    * keys
+        any iterable, even one which is slow to produce (e.g. lines read from a pipe): keys are read as they
+        come, while the previous ones are being downloaded, and sent together up to `chunk` at a time
+    * options
+        those of the command line: generate, max_num_authors, num_authors_short, journal_arXiv_fallback,
+        ads_workers, inspire_workers, ads_batch, inspire_batch, offline, refresh, cache, hedge
+
+    For example
+
+        for result in fillbib.fetch_many(["2016PhRvL.116f1102A", "Abbott:2016blz"], generate=True):
+            print(result.key, result.status, result.bibtex)
+    '''
+    return pipeline_citations(keys, fetch_options(**options), chunk)
+
+def pipeline_citations(keys, args, chunk=1000):
+    '''fetch_many, with the options given as an arguments object.'''
+    import queue
+    pending = queue.Queue()
+    end = object()
+
+    def read():
+        try:
+            for c in keys:
+                pending.put(c)
+        except Exception as e:
+            pending.put(e)
+        pending.put(end)
+    threading.Thread(target=read, daemon=True).start()
+
+    seen = set()
+    while True:
+        group = [pending.get()]
+        while group[-1] is not end and len(group) < chunk:
+            try:
+                group.append(pending.get_nowait())
+            except queue.Empty:
+                break
+        for c in group:
+            if isinstance(c, Exception):
+                raise c
+        finished = group[-1] is end
+        group = [c for c in group if c is not end and c not in seen]
+        seen.update(group)
+        for result in iter_citations(group, args):
+            yield result
+        if finished:
+            return
+
+async def fetch_many_async(keys, chunk=1000, **options):
+    '''
+    Same as fetch_many, as an asynchronous iterator:
+
+        async for result in fillbib.fetch_many_async(keys):
+            ...
+
+    The downloads run in a separate thread, so the event loop is never blocked.
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    results = asyncio.Queue()
+    end = object()
+
+    def produce():
+        try:
+            for result in fetch_many(keys, chunk, **options):
+                loop.call_soon_threadsafe(results.put_nowait, result)
+        except Exception as e:
+            loop.call_soon_threadsafe(results.put_nowait, e)
+        loop.call_soon_threadsafe(results.put_nowait, end)
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        result = await results.get()
+        if result is end:
+            return
+        if isinstance(result, Exception):
+            raise result
+        yield result
+
+@traced
+def parse_aux(auxfile, basename=None, seen=None):
+    '''
+    Citations and bibliography databases of a LaTeX document, from its aux file and from the aux
+    files it reads with \\@input (e.g. the chapters of a thesis added with \\include).
+    Returns the set of cited keys and the list of bib files (without extension).
+    '''
+    if basename is None:
+        basename = auxfile.split('.aux')[0]
+    if seen is None:
+        seen = set()
+    seen.add(os.path.abspath(auxfile))
+
+    # revtex names it after the job, which has no directory when the aux file is read from elsewhere
+    notes = (basename + 'Notes', os.path.basename(basename) + 'Notes')
+    cites, bibfiles = set(), []
     for line in open(auxfile,'r'):
+        # Citations will look like \citation{2004PhRvD..69j4017P,2004PhRvD..69j4017P}
         m = re.search(r'\\citation\{(.*)\}',line)   # find \citation{...}
         if m:
             cites.update(m.group(1).split(','))     # split by commas
+        m = re.search(r'\\bibdata\{(.*)\}',line)   # match \bibdata{...}, collect the ... note that we escape \, {, and }
+        if m:
+            for b in m.group(1).split(','):
+                if b not in notes and b not in bibfiles:  # Remove that annyoing feature of revtex which creates a *Notes.bib bibfile.
+                    bibfiles.append(b)
+        m = re.search(r'\\@input\{(.*)\}',line)   # aux file of an \include'd file
+        if m:
+            subaux = os.path.join(os.path.dirname(auxfile), m.group(1))
+            if os.path.isfile(subaux) and os.path.abspath(subaux) not in seen:
+                subcites, subbibfiles = parse_aux(subaux, basename, seen)
+                cites.update(subcites)
+                bibfiles.extend(b for b in subbibfiles if b not in bibfiles)
 
-    cites= cites.difference([
-        'REVTEX41Control','apsrev41Control',
-        'REVTEX42Control','apsrev42Control']) # Remove annoying entries of revtex
+    return cites, bibfiles
 
-    print("Seek:", cites)
+# Citations that revtex adds to the aux file, which are not in any database
+REVTEX_CONTROL = ['REVTEX41Control', 'apsrev41Control', 'REVTEX42Control', 'apsrev42Control']
 
-    # Check what you already have in the bib file
-    haves = []
-    if os.path.isfile(bibfile):
-        for line in open(bibfile,'r'):
-            m = re.search(r'@.*?\{(.*),',line)  # .*\{ means "any # of any char followed by {"; .*?\{ means "the shortest string matching any # of any char followed by {"
-            if m:
-                haves.append(m.group(1))
-    print("Have:", haves)
+def tex_inputs(texfile, seen=None):
+    '''
+    The tex file and all the files it reads with \\input, \\include or \\subfile, recursively.
+    Comments are ignored. Returns a list of file names (missing files are left out).
+    '''
+    if seen is None:
+        seen = []
+    if not os.path.isfile(texfile) or texfile in seen:
+        return seen
+    seen.append(texfile)
+    with open(texfile, 'r', errors='replace') as f:
+        for line in f:
+            line = re.sub(r'(?<!\\)%.*', '', line)
+            for m in re.finditer(r'\\(?:input|include|subfile)\s*\{([^}]+)\}', line):
+                name = os.path.join(os.path.dirname(texfile), m.group(1).strip())
+                if not os.path.isfile(name) and os.path.isfile(name + '.tex'):
+                    name = name + '.tex'
+                tex_inputs(name, seen)
+    return seen
+
+# The citation commands of natbib (\cite, \citep, \citet*, \citeauthor, ...) and biblatex (\parencite, \autocite,
+# \textcite, \footcite, ... and the multi-citation ones, \cites[see][]{a}{b}), with their optional arguments.
+# Other commands with cite in their name (\citestyle, \citetext) do not take keys.
+TEX_CITE = re.compile(r'\\(?:[Cc]ite(?:[pt]|al[tp]|author|year|yearpar|num|title|date|url|s)?|nocite|fullcite|footfullcite'
+                      r'|[Pp]arencites?|[Tt]extcites?|[Ff]ootcites?|footcitetext|[Ss]martcites?|[Aa]utocites?|[Ss]upercites?)'
+                      r'(?![a-zA-Z])\*?((?:\s*(?:\[[^\]]*\]|\([^)]*\)))*\s*\{[^}]*\}'
+                      r'(?:(?:\s*(?:\[[^\]]*\]|\([^)]*\)))*\s*\{[^}]*\})*)')
+TEX_BIB = re.compile(r'\\(?:bibliography|addbibresource|addglobalbib)\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}')
+
+@traced
+def tex_citations(texfile):
+    '''
+    Citations and bib files of a LaTeX document, read directly from its sources (and the files
+    they \\input or \\include) rather than from the aux file, so that they are known before
+    pdflatex runs. This is a best guess (citations hidden in macros are not found); the aux file
+    remains the reference. Returns the set of cited keys and the list of bib files.
+    '''
+    cites, bibfiles = set(), []
+    directory = os.path.dirname(texfile)
+    for name in tex_inputs(texfile):
+        with open(name, 'r', errors='replace') as f:
+            text = re.sub(r'(?<!\\)%.*', '', f.read())
+        for m in TEX_CITE.finditer(text):
+            for group in re.findall(r'\{([^}]*)\}', m.group(1)):
+                cites.update(c.strip() for c in group.split(',') if c.strip() and c.strip() != '*')
+        for m in TEX_BIB.finditer(text):
+            for b in m.group(1).split(','):
+                b = os.path.join(directory, b.strip())
+                b = b if b.endswith('.bib') else b + '.bib'
+                if b not in bibfiles:
+                    bibfiles.append(b)
+    return cites, bibfiles
+
+def replace_keys(texfiles, replacements):
+    '''
+    Replace citation keys in tex files, e.g. preprints which have been published. All keys are replaced
+    in a single pass over each file, and only the files which change are written (atomically).
+    Returns the list of files that changed.
+    '''
+    if not replacements:
+        return []
+    # Whole keys only, as they appear in \cite{a, b}
+    pattern = re.compile(r'(?<![^\s{,])(' + '|'.join(re.escape(c) for c in sorted(replacements, key=len, reverse=True))
+                         + r')(?![^\s},])')
+    changed = []
+    for texfile in texfiles:
+        with open(texfile, 'r') as f:
+            texdata = f.read()
+        newdata = pattern.sub(lambda m: replacements[m.group(1)], texdata)
+        if newdata != texdata:
+            with atomic_write(texfile) as f:
+                f.write(newdata)
+            changed.append(texfile)
+    return changed
+
+def fingerprint(cites, bibfiles, args):
+    '''
+    Everything fillbib_tex depends on: the citations, the state of the bib files, and the options, as a single
+    line of text. This is saved as it is rather than hashed, which would cost more to set up than to compare.
+    '''
+    state = {'cites': sorted(cites), 'bibfiles': [], 'options': [args.generate, args.max_num_authors,
+             args.num_authors_short, args.journal_arXiv_fallback, args.journals, args.updatepublished, args.hedge]}
+    for bibfile in bibfiles:
+        if os.path.isfile(bibfile):
+            st = os.stat(bibfile)
+            state['bibfiles'].append([bibfile, st.st_size, st.st_mtime_ns])
+        else:
+            state['bibfiles'].append([bibfile, None, None])
+    return json.dumps(state, separators=(',', ':'))
 
+def new_entries(missing, found, updatepublished=True):
+    '''
+    The entries to add to a bib file, given what ADS and INSPIRE returned for the missing keys ({key: bibtex}).
+    Returns a list of (key, bibtex), in the order of `missing`, and a dictionary of the keys to replace in the
+    tex files (ADS preprints which have been published, if updatepublished).
+    '''
+    entries = []
+    replacements = {}
 
-    # Query ADS and INSPIRE
-    bibtex = open(bibfile,'a')      # open for appending
+    for c in missing: # Write in a deterministic order, whatever order the queries came back in
 
-    for c in cites:
-        if c and c not in haves: # c is something and you don't have it already
+        bib = found[c]
 
-            if not c[0].isalpha(): # The first charachter is a number: could be on ADS
+        if not c[0].isalpha(): # The first charachter is a number: could be on ADS
 
-                try:
-                    bib = ads_citation(c)
+            try:
+                cfound = bib.split("{")[1].split(',')[0]
 
-                    cfound = bib.split("{")[1].split(',')[0]
-                    
-                    if  cfound == c: # Check you got what you where looking for
-                        pass
-                    elif 'arXiv' in c: # Take care of preprint on ADS
+                if  cfound == c: # Check you got what you where looking for
+                    pass
+                elif 'arXiv' in c: # Take care of preprint on ADS
 
-                        if args.updatepublished and '.tmp.' not in cfound:
-                            print("ADS replace", c, "-->", cfound)
-                            # This substitute the new ID into the tex file. Use at your own risk. The .tmp. condition fixes those stupid MNRAS temp entries.
-                            texdata = texdata.replace(c, cfound)
+                    if updatepublished and '.tmp.' not in cfound:
+                        print("ADS replace", c, "-->", cfound)
+                        # This substitute the new ID into the tex file. Use at your own risk. The .tmp. condition fixes those stupid MNRAS temp entries.
+                        replacements[c] = cfound
 
-                        else: 
-                            # This subsitute the arxiv id back in to the bib file
-                            bib = bib.split("{")[0]+"{"+c+","+",".join(bib.split(",")[1:])
+                    else: 
+                        # This subsitute the arxiv id back in to the bib file
+                        bib = bib.split("{")[0]+"{"+c+","+",".join(bib.split(",")[1:])
 
-                    bibtex.write(bib)
-                    print("ADS Found:", c)
-                except:
-                    print("ADS Not found:", c)
+                entries.append((bib.split("{")[1].split(',')[0], bib))
+                print("ADS Found:", c)
+            except:
+                print("ADS Not found:", c)
 
-            else: # The first charachter is not a number: could be on INSPIRE
+        else: # The first charachter is not a number: could be on INSPIRE
 
-                try:
-                    bib = inspire_citation(c,
-                        generate=args.generate,
-                        max_num_authors=args.max_num_authors,
-                        num_authors_short=args.num_authors_short,
-                        journal_arXiv_fallback=args.journal_arXiv_fallback)
-                    bibtex.write(bib)
-                    print("INSPIRE Found:", c)
-                except:
-                    print("INSPIRE Not found:", c)
+            if bib is None:
+                print("INSPIRE Not found:", c)
+            else:
+                entries.append((c, bib))
+                print("INSPIRE Found:", c)
+
+    return entries, replacements
+
+def copy_bytes(f, out, size=None, chunk=1<<20):
+    '''Copy `size` bytes (everything if None) from a file to another, a chunk at a time.'''
+    last = b''
+    while size is None or size > 0:
+        data = f.read(chunk if size is None else min(chunk, size))
+        if not data:
+            break
+        out.write(data)
+        last = data[-1:]
+        if size is not None:
+            size -= len(data)
+    return last
+
+def add_entries(bibfile, entries, clean=True):
+    '''
+    Add new entries [(key, bibtex)] to a bib file, leaving out those which are already there. The bib file
+    and the new entries (cleaned up with clean_entry) are written to a new file, which then replaces it;
+    call this within bib_lock. Returns the entries which were added.
+    '''
+    haves = bib_keys(bibfile)
+    new = []
+    for key, bib in entries:
+        if key not in haves:
+            haves.add(key)
+            new.append((key, bib))
+    if not new:
+        return []
+    if clean:
+        with TRACE.span("journals", entries=len(new)):
+            new = [(key, clean_entry(bib)) for key, bib in new]
+    with atomic_write(bibfile, 'wb') as out:
+        last = b''
+        if os.path.isfile(bibfile):
+            with open(bibfile, 'rb') as f:
+                last = copy_bytes(f, out)
+        if last and last != b'\n':
+            out.write(b'\n')
+        for key, bib in new:
+            out.write(bib.encode('utf-8', 'surrogateescape'))
+    save_bib_index(bibfile, haves)
+    return new
+
+@contextlib.contextmanager
+def bib_lock(bibfile):
+    '''
+    Hold an exclusive lock on a bib file, so that several fillbib runs sharing it (e.g. the papers of a
+    project) do not write it at the same time. The lock is on a hidden file next to it, which survives
+    the bib file being replaced. Does nothing where fcntl is not available.
+    '''
+    if fcntl is None:
+        yield
+        return
+    directory, name = os.path.split(bibfile)
+    with open(os.path.join(directory, '.' + name + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
+@traced
+def fillbib_tex(args):
 
+    basename = args.texfile[0].split('.tex')[0]
+    auxfile = basename + '.aux'
+    stampfile = basename + '.fillbib'
 
-    bibtex.close()
+    # Get all citations and bib files from aux file (and those of included files)
+    cites, bibfiles = parse_aux(auxfile, basename)
+    bibfiles = [b + '.bib' for b in bibfiles]
 
-    if args.updatepublished:
-        with open(basename+".tex", 'w') as texfile:
-            texfile.write(texdata)
+    if args.bibtex is None:     # Get the name of the bibfile from the aux file. New entries go into the first one.
+        if not bibfiles:
+            print("No bibliography in", auxfile)
+            return
+        bibfile = bibfiles[0]
+    else:    # Bibfile specified from argv
+        bibfile = args.bibtex.split('.bib')[0] + '.bib'
+        bibfiles = [bibfile] + [b for b in bibfiles if b != bibfile]
 
-    # Clean up journal names
-    if args.journals:
-        journals(bibfile)
+    cites= cites.difference(REVTEX_CONTROL) # Remove annoying entries of revtex
+
+    # Nothing to do if neither the citations nor the bib files changed since the last run
+    if not args.refresh and os.path.isfile(stampfile):
+        with open(stampfile, 'r') as f:
+            if f.read().strip() == fingerprint(cites, bibfiles, args):
+                print("Citations unchanged, nothing to do")
+                return
+
+    print("Seek:", cites)
+
+    # Check what you already have in the bib files
+    haves = bib_keys(bibfile)
+    others = set()
+    for b in bibfiles:
+        if b != bibfile:
+            others.update(bib_keys(b))
+    print("Have:", cites.intersection(haves.union(others)))
+
+
+    # Query ADS and INSPIRE
+    missing = sorted(c for c in cites if c and c not in haves and c not in others) # c is something and you don't have it already
+    failed = set()
+    found = fetch_citations(missing, args, failed)
+
+    entries, replacements = new_entries(missing, found, args.updatepublished)
+
+    if replacements:
+        replace_keys(tex_inputs(basename + '.tex'), replacements)
+
+    # Add the new entries, with journal names cleaned up. Keys added by another run in the meantime are left out.
+    with bib_lock(bibfile):
+        add_entries(bibfile, entries, args.journals)
+
+    # Remember what we have done, unless some query failed or some key was not found: those should be tried
+    # again (keys not found are only looked up again once their entry in the cache expires)
+    if not failed and all(found.get(c) is not None for c in missing):
+        with open(stampfile, 'w') as f:
+            f.write(fingerprint(cites, bibfiles, args) + '\n')
 
     
-def fillbib_list(args):
-    for c in args.keys:
-        if not c[0].isalpha():
-            bib = ads_citation(c)
-            if bib is None:
-                sys.stderr.write("ADS Not Found: {}\n".format(c))
+def fillbib_prefetch(args):
+    '''
+    Download the entries cited in a tex document, and missing from its bib files, into the local cache
+    only. filltex runs this while pdflatex is busy with the first pass, so that the following
+    `fillbib tex` finds them in the cache.
+    '''
+    if args.no_cache or args.offline:
+        return
+    basename = args.texfile[0].split('.tex')[0]
+    cites, bibfiles = tex_citations(basename + '.tex')
+    haves = set()
+    for b in bibfiles:
+        haves.update(bib_keys(b))
+    missing = sorted(c for c in cites if c not in haves)
+    found = fetch_citations(missing, args)
+    print("Prefetched {} of {} citations".format(sum(bib is not None for bib in found.values()), len(missing)))
+
+def project_documents(path):
+    """
+    The aux files of the documents of a project: those in a directory and its subdirectories which
+    have a tex file with the same name, or those of the tex files listed in a manifest file (one per
+    line, relative to the manifest; lines starting with # are ignored). Chapters read by another
+    document with \\include are not documents of their own.
+    """
+    auxfiles = []
+    if os.path.isdir(path):
+        for directory, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            auxfiles += [os.path.join(directory, f) for f in sorted(files) if f.endswith('.aux') and f[:-4] + '.tex' in files]
+    else:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    auxfiles.append(os.path.join(os.path.dirname(path), line.split('.tex')[0] + '.aux'))
+
+    included = set()
+    for auxfile in auxfiles:
+        if os.path.isfile(auxfile):
+            seen = set()
+            parse_aux(auxfile, seen=seen)
+            included.update(seen.difference([os.path.abspath(auxfile)]))
+    return [auxfile for auxfile in auxfiles if os.path.isfile(auxfile) and os.path.abspath(auxfile) not in included]
+
+@traced
+def fillbib_project(args):
+    """
+    Fill the bibliographies of many documents sharing bib files (e.g. the papers and thesis of a group)
+    in a single run. The citations of all documents are collected first, so that each missing key is
+    downloaded once; then each bib file gets all its new entries in a single locked and atomic write,
+    and the journal names of the new entries are cleaned up in the same pass.
+    """
+    documents = project_documents(args.path[0])
+    if not documents:
+        print("No documents found in", args.path[0])
+        return
+
+    targets = {} # {bib file: keys to add}
+    texfiles = {} # {document: keys it cites}
+    for auxfile in documents:
+        basename = auxfile.split('.aux')[0]
+        directory = os.path.dirname(auxfile)
+        cites, bibfiles = parse_aux(auxfile, basename)
+        if not bibfiles:
+            continue
+        cites = cites.difference(REVTEX_CONTROL)
+        bibfiles = [os.path.join(directory, b + '.bib') for b in bibfiles]
+        haves = set()
+        for b in bibfiles:
+            haves.update(bib_keys(b))
+        targets.setdefault(os.path.normpath(bibfiles[0]), set()).update(c for c in cites if c and c not in haves)
+        texfiles[basename + '.tex'] = cites
+    print("Documents:", len(texfiles), "Bib files:", len(targets))
+
+    # Each key only once, whatever the number of documents and bib files citing it
+    missing = sorted(set().union(*targets.values()))
+    print("Seek:", len(missing), "keys")
+    found = fetch_citations(missing, args)
+
+    replacements = {}
+    for bibfile in sorted(targets):
+        entries, newkeys = new_entries(sorted(targets[bibfile]), found, args.updatepublished)
+        replacements.update(newkeys)
+        if not entries:
+            continue
+        with bib_lock(bibfile):
+            entries = add_entries(bibfile, entries, args.journals)
+        print("Added {} entries to {}".format(len(entries), bibfile))
+
+    for texfile, cites in sorted(texfiles.items()):
+        replace_keys(tex_inputs(texfile), {c: replacements[c] for c in cites if c in replacements})
+
+def is_preprint(key, bib):
+    '''Whether a BibTeX record is an arXiv preprint which may have been published since.'''
+    if backend(key) == "ADS" and 'arXiv' not in key:
+        return False
+    if backend(key) == "INSPIRE" and not re.search(r'\beprint\s*=', bib, re.IGNORECASE):
+        return False
+    m = JOURNAL_FIELD.search(bib)
+    return m is None or m.group(2).strip('{}" ') in ('', 'arXiv', 'arXiv e-prints')
+
+@traced
+def fillbib_refresh(args):
+    '''
+    Bring the preprints in the bib files of a document up to date. All the preprint entries are
+    downloaded again at once (ignoring the cache), and those which have been published are replaced
+    in the bib files. With updatepublished, ADS preprint keys are replaced with the bibcode of the
+    published paper in all the tex files of the document.
+    '''
+    basename = args.texfile[0].split('.tex')[0]
+    if args.bibtex is not None:
+        bibfiles = [args.bibtex.split('.bib')[0] + '.bib']
+    elif os.path.isfile(basename + '.aux'):
+        bibfiles = [b + '.bib' for b in parse_aux(basename + '.aux', basename)[1]]
+    else:
+        bibfiles = tex_citations(basename + '.tex')[1]
+    bibfiles = [b for b in bibfiles if os.path.isfile(b)]
+
+    preprints, keys = {}, set()
+    for bibfile in bibfiles:
+        with open(bibfile, 'r') as f:
+            for key, bib in iter_bibtex(f):
+                if key:
+                    keys.add(key)
+                    if is_preprint(key, bib):
+                        preprints[key] = bibfile
+    print("Preprints:", sorted(preprints))
+
+    refresh = argparse.Namespace(**vars(args))
+    refresh.refresh = True
+    found = fetch_citations(sorted(preprints), refresh)
+
+    updates, replacements = {}, {}
+    for c in sorted(preprints):
+        bib = found.get(c)
+        if bib is None or is_preprint(c, bib):
+            continue
+        cfound = bib.split("{")[1].split(',')[0].strip()
+        if backend(c) == "ADS" and cfound != c:
+            if args.updatepublished and '.tmp.' not in cfound:
+                replacements[c] = cfound
+                if cfound in keys: # The published paper is already there
+                    bib = ''
+                keys.add(cfound)
             else:
-                print(bib)
+                bib = bib.split("{")[0]+"{"+c+","+",".join(bib.split(",")[1:])
+        updates[c] = bib
+        print(backend(c), "published:", c, "--> " + replacements[c] if c in replacements else "")
+    if args.journals:
+        with TRACE.span("journals", entries=len(updates)):
+            updates = {c: clean_entry(bib) for c, bib in updates.items()}
+
+    for bibfile in bibfiles:
+        if not any(preprints[c] == bibfile for c in updates):
+            continue
+        newkeys = set()
+        # Locked from the read to the rewrite, so that entries added meanwhile by fillbib tex are not lost
+        with bib_lock(bibfile):
+            with open(bibfile, 'r') as f, atomic_write(bibfile) as out:
+                for key, bib in iter_bibtex(f):
+                    if key in updates and preprints[key] == bibfile:
+                        # Keep what follows the record (blank lines, comments)
+                        end = max(bib.rfind('}'), bib.rfind(')')) + 1
+                        bib = updates[key].rstrip() + bib[end:] if updates[key] else ''
+                        key = replacements.get(key, key) if bib else None
+                    out.write(bib)
+                    if key:
+                        newkeys.add(key)
+            save_bib_index(bibfile, newkeys)
+
+    for texfile in replace_keys(tex_inputs(basename + '.tex'), replacements):
+        print("Updated", texfile)
+    print("Refreshed {} of {} preprints".format(len(updates), len(preprints)))
+
+@traced
+def fillbib_list(args):
+    keys = args.keys
+    if args.stdin: # Keys separated by spaces, commas or new lines, after those on the command line
+        import itertools
+        keys = itertools.chain(args.keys, (c for line in sys.stdin for c in re.split(r'[\s,]+', line) if c))
+
+    if args.format == "ndjson": # One JSON object per line, as soon as each key is done
+        for result in pipeline_citations(keys, args):
+            print(json.dumps(result._asdict()), flush=True)
+        return
+
+    keys = list(keys)
+    found = fetch_citations(keys, args)
+    for c in keys:
+        bib = found[c]
+        if bib is None:
+            sys.stderr.write("{} Not Found: {}\n".format(backend(c), c))
         else:
-            bib = inspire_citation(c,
-                    generate=args.generate,
-                    max_num_authors=args.max_num_authors,
-                    num_authors_short=args.num_authors_short,
-                    journal_arXiv_fallback=args.journal_arXiv_fallback)
-            if bib is None:
-                sys.stderr.write("INSPIRE Not Found: {}\n".format(c))
-            else:
-                print(bib)
-
+            print(bib)
 
-def curly(x):
-   '''Just a curly bracket sandwich.'''
-   return "{"+x+"}"
 
-def journals(bibfile):
+@traced
+def fillbib_tidy(args):
+    '''
+    Tidy up a bib file: drop the records whose key appeared before, clean up journal names, leave a single
+    blank line between records and, with --sort, sort them by key (@string and @preamble records stay at
+    the top). Records are read one at a time; only their position in the file is kept in memory.
     '''
-    Clean up the names of some journals using their ISO4 standards.
+    bibfile = args.bibfile[0].split('.bib')[0] + '.bib'
+    seen, entries, duplicates = set(), [], 0
+    # Locked from the first read to the rewrite, so that entries added meanwhile by fillbib tex are not lost
+    with bib_lock(bibfile), open(bibfile, 'rb') as f:
+        for entry, bib in bib_entries(f):
+            if entry.key is not None and entry.key in seen:
+                print("Duplicate:", entry.key)
+                duplicates += 1
+                continue
+            if entry.key is not None:
+                seen.add(entry.key)
+            if entry.key is not None or bib.strip():
+                entries.append(entry)
+        if args.sort:
+            entries.sort(key=lambda entry: (entry.key is not None, entry.key or ''))
+
+        # Records are cleaned up as they are written: the time spent on journal names is added up into one stage
+        start, cleaning = time.time(), 0.
+        with atomic_write(bibfile, 'wb') as out:
+            for entry in entries:
+                bib = entry.read(f)
+                if args.journals and entry.key is not None:
+                    t = time.time()
+                    bib = clean_entry(bib)
+                    cleaning += time.time() - t
+                out.write((bib.strip() + '\n\n').encode('utf-8', 'surrogateescape'))
+        if args.journals and TRACE.enabled:
+            TRACE.record("journals", start, cleaning, entries=len(seen))
+        save_bib_index(bibfile, seen)
+    print("{} records, {} duplicates removed".format(len(seen), duplicates))
+
+
+# The format is: [ADS name, INSPIRE name, ISO4 abbreviation]
+JOURNALS = [
+    ####
+    # These are the journals from the ADS macros: https://ui.adsabs.harvard.edu/help/actions/journal-macros
+    # I could not find them all on INSPIRE, some are missing.
+    ####
+    ['\\aj', 'Astron. J.', 'Astron. J.'],
+    ['\\actaa', 'Acta Astron.', 'Acta Astronom.'],
+    ['\\araa', 'Ann. Rev. Astron. Astrophys.', 'Annu. Rev. Astron. Astrophys.'],
+    ['\\apj', 'Astrophys. J.', 'Astrophys. J.'],
+    ['\\apjl', 'Astrophys. J. Lett.', 'Astrophys. J. Lett.'],
+    ['\\apjs', 'Astrophys. J. Suppl.', 'Astrophys. J. Supp. S.'],
+    ['\\ao', 'Appl. Opt.', 'Appl. Optics'],
+    ['\\apss', 'Astrophys. Space Sci.', 'Astrophys. Space Sci.'],
+    ['\\aap', 'Astron. Astrophys.', 'Astron. Astrophys.'],
+    ['\\aapr', 'Astron. Astrophys. Rev.', 'Astron. Astrophys. Rev.'],
+    ['\\aaps', 'Astron. Astrophys. Suppl. Ser.', 'Astron. Astrophys. Sup.'],
+    ['\\azh', '', 'Astron. Zh.'], #Not sure. Various names on inspire
+    ['\\baas', 'Bull. Am. Astron. Soc.', 'Bull. Am. Astron. Soc.'],
+    ['\\bac', 'Bull. Astron. Inst. Czech.', 'B. Astron. I. Czech.'],
+    ['\\caa', 'Chin. Astron. Astrophys.', 'Chinese Astron. Astr.'],
+    ['\\cjaa', 'Chin. J. Astron. Astrophys.', 'Chinese J. Astron. Ast.'],
+    ['\\icarus', 'Icarus', 'Icarus'],
+    ['\\jcap', 'JCAP', 'J. Cosmology Astropart. Phys.'],
+    ['\\jrasc', 'J. Roy. Astron. Soc. Canada', 'J. Roy Astron. Soc. Can.'],
+    ['\\memras', 'Mem. Roy. Astron. Soc.', 'Mem. R. Astron. Soc.'],
+    ['\\mnras', 'Mon. Not. Roy. Astron. Soc.', 'Mon. Not. R. Astron. Soc.'],
+    ['\\na', 'New Astron.', 'New Astron.'],
+    ['\\nar', 'New Astron. Rev.', 'New Astron. Rev.'],
+    ['\\pra', 'Phys. Rev. A', 'Phys. Rev. A'],
+    ['\\prb', 'Phys. Rev. B', 'Phys. Rev. B'],
+    ['\\prc', 'Phys. Rev. C', 'Phys. Rev. C'],
+    ['\\prd', 'Phys. Rev. D', 'Phys. Rev. D'],
+    ['\\pre', 'Phys. Rev. E', 'Phys. Rev. E'],
+    ['\\prl', 'Phys. Rev. Lett.', 'Phys. Rev. Lett.'],
+    ['\\pasa', 'Publ. Astron. Soc. Austral.', 'Publ. Astron. Soc. Aust.'],
+    ['\\pasp', 'Publ. Astron. Soc. Pac.', 'Publ. Astron. Soc. Pac.'],
+    ['\\pasj', 'Publ. Astron. Soc. Jap.', 'Publ. Astron. Soc. Jpn.'],
+    ['\\rmxaa', 'Rev. Mex. Astron. Astrofis.', 'Rev. Mex. Astron. Astr.'],
+    ['\\qjras', 'Q. J. Roy. Astron. Soc.', 'Q. J. Roy. Astron. Soc.'],
+    ['\\skytel', 'Sky Telesc.', 'Sky Telescope'],
+    ['\\solphys', 'Solar Phys.', 'Sol. Phys.'],
+    ['\\sovast', 'Sov. Astron.', 'Sov. Astron.'],
+    ['\\ssr', 'Space Sci. Rev.', 'Space Sci. Rev.'],
+    ['\\zap', 'Z. Astrophys.', 'Z. Astrophys.'],
+    ['\\nat', 'Nature', 'Nature'],
+    ['\\iaucirc', 'IAU Circ.', 'IAU Circ.'],
+    ['\\aplett', 'Astrophys. Lett.', 'Astrophys. Lett.'],
+    ['\\apspr', '', 'Astrophys.~Space~Phys.~Res.'], #Could not find it on INSPIRE
+    ['\\bain', 'Bull. Astron. Inst. Netherlands', 'B. Astron. I. Neth.'],
+    ['\\fcp', 'Fund. Cosmic Phys.', 'Fund. Cosmic Phys.'],
+    ['\\gca', 'Geochim. Cosmochim. Acta', 'Geochim. Cosmochim. Ac.'],
+    ['\\grl', 'Geophys. Res. Lett.', 'Geophys. Res. Lett.'],
+    ['\\jcp', 'J. Chem. Phys.', 'J. Chem. Phys.'],
+    ['\\jgr', 'J. Geophys. Res.', 'J. Geophys. Res.'],
+    ['\\jqsrt', 'J. Quant. Spectrosc. Radiat. Trans.', 'J. Quant. Sprectrosc. Ra.'],
+    ['\\memsai', 'Mem. Soc. Ast. It.', 'Mem. Soc. Astron. Ital.'],
+    ['\\nphysa', 'Nucl. Phys. A', 'Nucl. Phys. A'],
+    ['\\physrep', 'Phys. Rept.', 'Phys. Rep.'],
+    ['\\physscr', 'Phys. Scripta', 'Phys. Scripta'],
+    ['\\planss', 'Planet. Space Sci.', 'Planet. Space Sci.'],
+    ['\\procspie', 'Proc. SPIE Int. Soc. Opt. Eng.', 'P. Soc. Photo.-Opt. Ins.'],
+    ####
+    # [Davide Gerosa] These are journals that I personally encountered. 
+    # Will keep on adding to this list.
+    ####
+    ['Advances in Space Research','Adv. Space Res.','Adv. Space Res.'], #ISI list not correct
+    ['American Institute of Physics Conference Series','AIP Conf. Proc.','AIP Conf. Proc.'],
+    ['American Journal of Physics','Am. J. Phys.','Am. J. Phys.'],
+    ['Annals of Data Science','Ann. Data Sci.','Ann. Data Sci.'],
+    ['Astronomy and Computing','Astron. Comput.','Astron. Comput.'],
+    ['Astroparticle Physics','Astropart. Phys.','Astropart. Phys.'],
+    ['Astrophysics and Space Science Library','Astrophys. Space Sci. Libr.','Astrophys. Space Sc. L.'],
+    ['Astrophysics and Space Science Library','Astrophys. Space Sci. Libr.','Astrophys. Space Sc. L.'],
+    ['Bulletin of the American Astronomical Society','Bull. Am. Astron. Soc.','Bull. Am. Astron. Soc.'],
+    ['Classical and Quantum Gravity','Class. Quant. Grav.','Class. Quantum Grav.'], #ISI list not correct
+    ['Communications in Mathematical Physics', 'Commun. Math. Phys.', 'Commun. Math. Phys.'],
+    ['European Physical Journal C', 'Eur. Phys. J. C', 'Eur. Phys. J. C'],
+    ['Frontiers in Astronomy and Space Sciences','Front. Astron. Space Sci.','Front. Astron. Space Sci.'],
+    ['General Relativity and Gravitation', 'Gen. Rel. Grav.', 'Gen. Relat. Gravit.'],
+    ['International Journal of Modern Physics D', 'Int. J. Mod. Phys. D', 'Int. J. Mod. Phys. D'], 
+    ['iScience', 'iScience', 'iScience'], 
+    ['Journal of High Energy Physics','JHEP','J. High Energy Phys.'],
+    ['Journal of Machine Learning Research','J. Machine Learning Res.','J. Mach. Learn. Res.'],
+    ['Journal of Mathematical Analysis and Applications','J. Math. Anal. Appl.','J. Math. Anal. Appl'],
+    ['Journal of Physics Conference Series','J. Phys. Conf. Ser.','J. Phys. Conf. Ser.'],
+    ['Journal of Statistical Physics','J. Statist. Phys.','J. Stat. Phys.'],
+    ['Journal of the Royal Statistical Society B','J. Roy. Statist. Soc. B','J. Roy. Statist. Soc. B'],
+    ['Living Reviews in Relativity', 'Living Rev. Rel.', 'Living Rev. Relativ.'],
+    ['Machine Learning: Science and Technology','Mach. Learn. Sci. Tech.','Mach. Learn. Sci. Tech.'], #ISI list not correct
+    ['Machine Learning','Machine Learning','Mach. Learn.'],
+    ['Nature Astronomy', 'Nature Astron.', 'Nat. Astron.'],
+    ['Nature Methods', 'Nature Meth.', 'Nat. Methods'],
+    ['Nature Reviews Physics','Nature Rev. Phys.','Nat. Rev. Phys.'],
+    ['Physica A Statistical Mechanics and its Applications','Physica A','Physica A'],
+    ['Physica D Nonlinear Phenomena', 'Physica D', 'Physica D'],
+    ['Physical Review', 'Phys. Rev.', 'Phys. Rev.'],
+    ['Physical Review Research', 'Phys. Rev. Res.', 'Phys. Rev. Res.'],
+    ['Physical Review X', 'Phys. Rev. X', 'Phys. Rev. X'],
+    ['Physics Letters A', 'Phys. Lett. A', 'Phys. Lett. A'],
+    ['Proceedings of the Royal Society of London Series A', 'Proc. Roy. Soc. Lond. A', 'P. R. Soc. Lond. A'],
+    ['Proceedings of the National Academy of Science', 'Proc. Nat. Acad. Sci.', 'Proc. Natl. Acad. Sci. USA'],
+    ['Progress of Theoretical and Experimental Physics', 'PTEP', 'Prog. Theor. Exp. Phys.'],
+    ['Rendiconti Lincei. Scienze Fisiche e Naturali', 'Rend. Lincei Sci. Fis. Nat.', 'Rend. Lincei-Sci. Fis.'],
+    ['Reports on Progress in Physics', 'Rept. Prog. Phys.', 'Rep. Prog. Phys.'],
+    ['Research Notes of the American Astronomical Society', 'Res. Notes AAS','Res. Notes AAS'],
+    ['Reviews of Modern Physics', 'Rev. Mod. Phys.', 'Rev. Mod. Phys.'],
+    ['Science Advances','Sci. Adv.','Sci. Adv.'],
+    ['SIAM Journal on Scientific Computing','SIAM J. Sci. Comput.','SIAM J. Sci. Comput.'],
+    ['The Journal of Open Source Software','J. Open Source Softw.','J. Open Source Softw.'],
+]
+
+# Lookup table {ADS or INSPIRE name: ISO4 abbreviation}, built once
+JOURNAL_ABBREVIATIONS = {name: j[2] for j in reversed(JOURNALS) for name in j[:2] if name}
+
+# The journal field of a BibTeX record: journal = {...}, journal = {{...}} or journal = "..."
+JOURNAL_FIELD = re.compile(r'(\bjournal\s*=\s*)(\{\{[^{}]*\}\}|\{[^{}]*\}|"[^"]*")', re.IGNORECASE)
+# arXiv information repeated in ADS records of preprints
+ARXIV_REPEATED = re.compile(r'(?:[Pp]ages|[Ee]id) = \{arXiv:[0-9]+.[0-9]+\},|doi = \{[0-9]+.[0-9]+/arXiv.[0-9]+.[0-9]+\},')
+
+def journal_abbreviation(m):
+    '''Replace a matched journal field with its ISO4 abbreviation, if we know it.'''
+    value = m.group(2)
+    name = value.strip('{}"')
+    if name in JOURNAL_ABBREVIATIONS:
+        value = value.replace(name, JOURNAL_ABBREVIATIONS[name], 1)
+    return m.group(1) + value
+
+def clean_entry(bib):
+    '''
+    Clean up a single BibTeX record: ISO4 journal name, and no repeated arXiv information.
     Journal abbreviations are taken from https://images.webofknowledge.com/images/help/WOS/A_abrvjt.html
-    If your favourite journal is missing, please add it and send a pull request. Thanks!
-    '''
-
-    # The format is: [ADS name, INSPIRE name, ISO4 abbreviation]
-    journals = [
-            ####
-            # These are the journals from the ADS macros: https://ui.adsabs.harvard.edu/help/actions/journal-macros
-            # I could not find them all on INSPIRE, some are missing.
-            ####
-            ['\\aj', 'Astron. J.', 'Astron. J.'],
-            ['\\actaa', 'Acta Astron.', 'Acta Astronom.'],
-            ['\\araa', 'Ann. Rev. Astron. Astrophys.', 'Annu. Rev. Astron. Astrophys.'],
-            ['\\apj', 'Astrophys. J.', 'Astrophys. J.'],
-            ['\\apjl', 'Astrophys. J. Lett.', 'Astrophys. J. Lett.'],
-            ['\\apjs', 'Astrophys. J. Suppl.', 'Astrophys. J. Supp. S.'],
-            ['\\ao', 'Appl. Opt.', 'Appl. Optics'],
-            ['\\apss', 'Astrophys. Space Sci.', 'Astrophys. Space Sci.'],
-            ['\\aap', 'Astron. Astrophys.', 'Astron. Astrophys.'],
-            ['\\aapr', 'Astron. Astrophys. Rev.', 'Astron. Astrophys. Rev.'],
-            ['\\aaps', 'Astron. Astrophys. Suppl. Ser.', 'Astron. Astrophys. Sup.'],
-            ['\\azh', '', 'Astron. Zh.'], #Not sure. Various names on inspire
-            ['\\baas', 'Bull. Am. Astron. Soc.', 'Bull. Am. Astron. Soc.'],
-            ['\\bac', 'Bull. Astron. Inst. Czech.', 'B. Astron. I. Czech.'],
-            ['\\caa', 'Chin. Astron. Astrophys.', 'Chinese Astron. Astr.'],
-            ['\\cjaa', 'Chin. J. Astron. Astrophys.', 'Chinese J. Astron. Ast.'],
-            ['\\icarus', 'Icarus', 'Icarus'],
-            ['\\jcap', 'JCAP', 'J. Cosmology Astropart. Phys.'],
-            ['\\jrasc', 'J. Roy. Astron. Soc. Canada', 'J. Roy Astron. Soc. Can.'],
-            ['\\memras', 'Mem. Roy. Astron. Soc.', 'Mem. R. Astron. Soc.'],
-            ['\\mnras', 'Mon. Not. Roy. Astron. Soc.', 'Mon. Not. R. Astron. Soc.'],
-            ['\\na', 'New Astron.', 'New Astron.'],
-            ['\\nar', 'New Astron. Rev.', 'New Astron. Rev.'],
-            ['\\pra', 'Phys. Rev. A', 'Phys. Rev. A'],
-            ['\\prb', 'Phys. Rev. B', 'Phys. Rev. B'],
-            ['\\prc', 'Phys. Rev. C', 'Phys. Rev. C'],
-            ['\\prd', 'Phys. Rev. D', 'Phys. Rev. D'],
-            ['\\pre', 'Phys. Rev. E', 'Phys. Rev. E'],
-            ['\\prl', 'Phys. Rev. Lett.', 'Phys. Rev. Lett.'],
-            ['\\pasa', 'Publ. Astron. Soc. Austral.', 'Publ. Astron. Soc. Aust.'],
-            ['\\pasp', 'Publ. Astron. Soc. Pac.', 'Publ. Astron. Soc. Pac.'],
-            ['\\pasj', 'Publ. Astron. Soc. Jap.', 'Publ. Astron. Soc. Jpn.'],
-            ['\\rmxaa', 'Rev. Mex. Astron. Astrofis.', 'Rev. Mex. Astron. Astr.'],
-            ['\\qjras', 'Q. J. Roy. Astron. Soc.', 'Q. J. Roy. Astron. Soc.'],
-            ['\\skytel', 'Sky Telesc.', 'Sky Telescope'],
-            ['\\solphys', 'Solar Phys.', 'Sol. Phys.'],
-            ['\\sovast', 'Sov. Astron.', 'Sov. Astron.'],
-            ['\\ssr', 'Space Sci. Rev.', 'Space Sci. Rev.'],
-            ['\\zap', 'Z. Astrophys.', 'Z. Astrophys.'],
-            ['\\nat', 'Nature', 'Nature'],
-            ['\\iaucirc', 'IAU Circ.', 'IAU Circ.'],
-            ['\\aplett', 'Astrophys. Lett.', 'Astrophys. Lett.'],
-            ['\\apspr', '', 'Astrophys.~Space~Phys.~Res.'], #Could not find it on INSPIRE
-            ['\\bain', 'Bull. Astron. Inst. Netherlands', 'B. Astron. I. Neth.'],
-            ['\\fcp', 'Fund. Cosmic Phys.', 'Fund. Cosmic Phys.'],
-            ['\\gca', 'Geochim. Cosmochim. Acta', 'Geochim. Cosmochim. Ac.'],
-            ['\\grl', 'Geophys. Res. Lett.', 'Geophys. Res. Lett.'],
-            ['\\jcp', 'J. Chem. Phys.', 'J. Chem. Phys.'],
-            ['\\jgr', 'J. Geophys. Res.', 'J. Geophys. Res.'],
-            ['\\jqsrt', 'J. Quant. Spectrosc. Radiat. Trans.', 'J. Quant. Sprectrosc. Ra.'],
-            ['\\memsai', 'Mem. Soc. Ast. It.', 'Mem. Soc. Astron. Ital.'],
-            ['\\nphysa', 'Nucl. Phys. A', 'Nucl. Phys. A'],
-            ['\\physrep', 'Phys. Rept.', 'Phys. Rep.'],
-            ['\\physscr', 'Phys. Scripta', 'Phys. Scripta'],
-            ['\\planss', 'Planet. Space Sci.', 'Planet. Space Sci.'],
-            ['\\procspie', 'Proc. SPIE Int. Soc. Opt. Eng.', 'P. Soc. Photo.-Opt. Ins.'],
-            ####
-            # [Davide Gerosa] These are journals that I personally encountered. 
-            # Will keep on adding to this list.
-            ####
-            ['Advances in Space Research','Adv. Space Res.','Adv. Space Res.'], #ISI list not correct
-            ['American Institute of Physics Conference Series','AIP Conf. Proc.','AIP Conf. Proc.'],
-            ['American Journal of Physics','Am. J. Phys.','Am. J. Phys.'],
-            ['Annals of Data Science','Ann. Data Sci.','Ann. Data Sci.'],
-            ['Astronomy and Computing','Astron. Comput.','Astron. Comput.'],
-            ['Astroparticle Physics','Astropart. Phys.','Astropart. Phys.'],
-            ['Astrophysics and Space Science Library','Astrophys. Space Sci. Libr.','Astrophys. Space Sc. L.'],
-            ['Astrophysics and Space Science Library','Astrophys. Space Sci. Libr.','Astrophys. Space Sc. L.'],
-            ['Bulletin of the American Astronomical Society','Bull. Am. Astron. Soc.','Bull. Am. Astron. Soc.'],
-            ['Classical and Quantum Gravity','Class. Quant. Grav.','Class. Quantum Grav.'], #ISI list not correct
-            ['Communications in Mathematical Physics', 'Commun. Math. Phys.', 'Commun. Math. Phys.'],
-            ['European Physical Journal C', 'Eur. Phys. J. C', 'Eur. Phys. J. C'],
-            ['Frontiers in Astronomy and Space Sciences','Front. Astron. Space Sci.','Front. Astron. Space Sci.'],
-            ['General Relativity and Gravitation', 'Gen. Rel. Grav.', 'Gen. Relat. Gravit.'],
-            ['International Journal of Modern Physics D', 'Int. J. Mod. Phys. D', 'Int. J. Mod. Phys. D'], 
-            ['iScience', 'iScience', 'iScience'], 
-            ['Journal of High Energy Physics','JHEP','J. High Energy Phys.'],
-            ['Journal of Machine Learning Research','J. Machine Learning Res.','J. Mach. Learn. Res.'],
-            ['Journal of Mathematical Analysis and Applications','J. Math. Anal. Appl.','J. Math. Anal. Appl'],
-            ['Journal of Physics Conference Series','J. Phys. Conf. Ser.','J. Phys. Conf. Ser.'],
-            ['Journal of Statistical Physics','J. Statist. Phys.','J. Stat. Phys.'],
-            ['Journal of the Royal Statistical Society B','J. Roy. Statist. Soc. B','J. Roy. Statist. Soc. B'],
-            ['Living Reviews in Relativity', 'Living Rev. Rel.', 'Living Rev. Relativ.'],
-            ['Machine Learning: Science and Technology','Mach. Learn. Sci. Tech.','Mach. Learn. Sci. Tech.'], #ISI list not correct
-            ['Machine Learning','Machine Learning','Mach. Learn.'],
-            ['Nature Astronomy', 'Nature Astron.', 'Nat. Astron.'],
-            ['Nature Methods', 'Nature Meth.', 'Nat. Methods'],
-            ['Nature Reviews Physics','Nature Rev. Phys.','Nat. Rev. Phys.'],
-            ['Physica A Statistical Mechanics and its Applications','Physica A','Physica A'],
-            ['Physica D Nonlinear Phenomena', 'Physica D', 'Physica D'],
-            ['Physical Review', 'Phys. Rev.', 'Phys. Rev.'],
-            ['Physical Review Research', 'Phys. Rev. Res.', 'Phys. Rev. Res.'],
-            ['Physical Review X', 'Phys. Rev. X', 'Phys. Rev. X'],
-            ['Physics Letters A', 'Phys. Lett. A', 'Phys. Lett. A'],
-            ['Proceedings of the Royal Society of London Series A', 'Proc. Roy. Soc. Lond. A', 'P. R. Soc. Lond. A'],
-            ['Proceedings of the National Academy of Science', 'Proc. Nat. Acad. Sci.', 'Proc. Natl. Acad. Sci. USA'],
-            ['Progress of Theoretical and Experimental Physics', 'PTEP', 'Prog. Theor. Exp. Phys.'],
-            ['Rendiconti Lincei. Scienze Fisiche e Naturali', 'Rend. Lincei Sci. Fis. Nat.', 'Rend. Lincei-Sci. Fis.'],
-            ['Reports on Progress in Physics', 'Rept. Prog. Phys.', 'Rep. Prog. Phys.'],
-            ['Research Notes of the American Astronomical Society', 'Res. Notes AAS','Res. Notes AAS'],
-            ['Reviews of Modern Physics', 'Rev. Mod. Phys.', 'Rev. Mod. Phys.'],
-            ['Science Advances','Sci. Adv.','Sci. Adv.'],
-            ['SIAM Journal on Scientific Computing','SIAM J. Sci. Comput.','SIAM J. Sci. Comput.'],
-            ['The Journal of Open Source Software','J. Open Source Softw.','J. Open Source Softw.'],
-            ]
-
-    with open(bibfile, 'r') as bibtex :
-        filedata = bibtex.read()
-
-    for j in journals:
-        print(j)
-        if j[0]:
-            filedata = filedata.replace(curly(j[0]), curly(j[2]))
-        if j[1]:
-            filedata = filedata.replace(curly(j[1]), curly(j[2]))
-            filedata = filedata.replace('journal = "'+j[1], 'journal = "'+j[2])
-
-    ### Clean up arxiv repeated information in ADS records:
-    filedata = filedata.replace('arXiv e-prints', '{}')
-    filedata = re.sub('pages = {arXiv:[0-9]+.[0-9]+},','',filedata)
-    filedata = re.sub('Pages = {arXiv:[0-9]+.[0-9]+},','',filedata)
-    filedata = re.sub('eid = {arXiv:[0-9]+.[0-9]+},','',filedata)
-    filedata = re.sub('Eid = {arXiv:[0-9]+.[0-9]+},','',filedata)
-    filedata = re.sub('doi = {[0-9]+.[0-9]+/arXiv.[0-9]+.[0-9]+},','',filedata)
-
-    with open(bibfile, 'w') as bibtex :
-        bibtex.write(filedata)
+    If your favourite journal is missing, please add it to JOURNALS and send a pull request. Thanks!
+    '''
+    bib = JOURNAL_FIELD.sub(journal_abbreviation, bib)
+    bib = bib.replace('arXiv e-prints', '{}')
+    return ARXIV_REPEATED.sub('', bib)
 
 
+class Watcher(object):
+    '''
+    Wait for files to change. Uses inotify on Linux, and otherwise checks the modification times
+    twice a second. Events are collected until nothing happens for `debounce` seconds, so that a
+    save which writes several files (or the same file several times) gives a single rebuild.
+    '''
 
+    def __init__(self, debounce=0.5):
+        self.debounce = debounce
+        self.files = {}
+        self.polled = {}    # Modification times at the last check, when polling
+        self.inotify = None
+        self.watches = {}
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes, ctypes.util
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                fd = self.libc.inotify_init()
+                if fd >= 0:
+                    self.inotify = fd
+            except (OSError, AttributeError):
+                pass
+
+    def set_files(self, files, times=None):
+        '''
+        The files to watch, which can change from one build to the next. `times` are the modification times
+        the files had when the build started ({name: mtime}), so that files saved during the build count as changed.
+        '''
+        times = times or {}
+        self.files = {os.path.abspath(f): times.get(os.path.abspath(f), self.mtime(f)) for f in files}
+        self.polled = dict(self.files)
+        if self.inotify is not None:
+            # Watch directories rather than files: editors often save by replacing the file
+            IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x08, 0x80, 0x100
+            for directory in set(os.path.dirname(f) for f in self.files):
+                if directory not in self.watches.values():
+                    wd = self.libc.inotify_add_watch(self.inotify, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                    if wd >= 0:
+                        self.watches[wd] = directory
+
+    @staticmethod
+    def mtime(f):
+        try:
+            return os.stat(f).st_mtime_ns
+        except OSError:
+            return None
+
+    def events(self, timeout):
+        '''Names of the watched files which changed, waiting at most `timeout` seconds.'''
+        if self.inotify is not None:
+            import select, struct
+            if not select.select([self.inotify], [], [], timeout)[0]:
+                return set()
+            data = os.read(self.inotify, 65536)
+            names = set()
+            while data:
+                wd, mask, cookie, length = struct.unpack('iIII', data[:16])
+                name = data[16:16+length].rstrip(b'\0').decode(errors='replace')
+                data = data[16+length:]
+                path = os.path.join(self.watches.get(wd, ''), name)
+                if path in self.files:
+                    names.add(path)
+            return names
+        time.sleep(min(timeout, 0.5))
+        names = set()
+        for f, t in self.polled.items():
+            if self.mtime(f) != t:
+                self.polled[f] = self.mtime(f)
+                names.add(f)
+        return names
+
+    def wait(self):
+        '''Block until some of the files change; returns their names.'''
+        while True:
+            # Files saved since the times given to set_files come first, then we wait for new changes
+            changed = set(f for f, t in self.files.items() if self.mtime(f) != t) or self.events(3600)
+            if not changed:
+                continue
+            while True:
+                more = self.events(self.debounce)
+                if not more:
+                    break
+                changed.update(more)
+            # Leave out the events of files which are back to the version we know (e.g. written by the build itself)
+            changed = set(f for f in changed if self.mtime(f) != self.files[f])
+            if changed:
+                for f in changed:
+                    self.files[f] = self.mtime(f)
+                return changed
+
+def run(command):
+    '''Run an external command (pdflatex, bibtex); returns True if it succeeded.'''
+    import subprocess
+    with TRACE.span(command[0], arg=command[-1]) as span:
+        span['status'] = subprocess.call(command)
+    return span['status'] == 0
+
+def latex_state(basename):
+    '''Hash of the files which pdflatex reads back in the next pass. When this stops changing, we are done.'''
+    import hashlib
+    h = hashlib.sha1()
+    directory = os.path.dirname(basename) or '.'
+    files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.aux'))
+    for f in files + [basename + ext for ext in ('.toc', '.lof', '.lot', '.out', '.bbl')]:
+        if os.path.isfile(f):
+            with open(f, 'rb') as fh:
+                h.update(fh.read())
+    return h.hexdigest()
+
+def bib_state(auxfile):
+    '''What bibtex reads for an aux file: its citations and bib files (with those of the aux files it reads), and the state of the bib files.'''
+    cites, bibfiles = parse_aux(auxfile)
+    state = [sorted(cites)]
+    for b in bibfiles:
+        state.append([b, Watcher.mtime(b + '.bib')])
+    return state
+
+def bibtex_aux_files(directory):
+    '''
+    The aux files of a directory which have a bibliography of their own (there are several with multibib
+    or chapterbib). Those of the \\include'd files without one are left out.
+    '''
+    auxfiles = []
+    for f in sorted(os.listdir(directory)):
+        if f.endswith('.aux'):
+            with open(os.path.join(directory, f), 'r', errors='replace') as aux:
+                if any(line.startswith('\\bibdata{') for line in aux):
+                    auxfiles.append(os.path.join(directory, f))
+    return auxfiles
+
+def run_bibtex(auxfile):
+    '''
+    Run bibtex on an aux file. The output is printed at the end, so that bibtex runs in parallel do not
+    mix their messages. Returns the exit status (1 for warnings, 2 for errors).
+    '''
+    import subprocess
+    with TRACE.span('bibtex', arg=auxfile) as span:
+        process = subprocess.Popen(['bibtex', auxfile], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        span['status'] = process.returncode
+    sys.stdout.write(output.decode(errors='replace'))
+    sys.stdout.flush()
+    return process.returncode
+
+def rerun_requested(basename):
+    '''pdflatex asks explicitly for another pass.'''
+    try:
+        with open(basename + '.log', 'r', errors='replace') as f:
+            return re.search(r'Rerun to get|Please rerun|Rerun LaTeX', f.read()) is not None
+    except OSError:
+        return False
 
-if __name__ == "__main__":
+def build(args, texchanged=True, state=None, maxpasses=5):
+    '''
+    Compile a document like filltex does, running only the stages whose inputs changed.
+    `state` is a dictionary kept from one build to the next (the last state of the bibliography of each aux file).
+    Returns True if the build succeeded.
+    '''
+    basename = args.texfile[0].split('.tex')[0]
+    if state is None:
+        state = {}
+    latex = ['pdflatex', '--synctex=1', '-halt-on-error', '-interaction=nonstopmode']
+
+    before = latex_state(basename)
+    if texchanged or not os.path.isfile(basename + '.aux'):
+        # Download the new citations while pdflatex runs
+        prefetch = threading.Thread(target=fillbib_prefetch, args=(args,))
+        prefetch.start()
+        ok = run(latex + ['-draftmode', basename + '.tex'])
+        prefetch.join()
+        if not ok:
+            print("pdflatex got an error")
+            return False
+
+    for npass in range(2, maxpasses):
+        fillbib_tex(args)
+
+        # bibtex, in parallel, for the aux files whose citations or bib files changed
+        jobs = {}
+        for auxfile in bibtex_aux_files(os.path.dirname(basename) or '.'):
+            bib = bib_state(auxfile)
+            if not os.path.isfile(auxfile[:-len('.aux')] + '.bbl') or bib != state.get(auxfile):
+                jobs[worker_pool('bibtex', os.cpu_count() or 1).submit(run_bibtex, auxfile)] = (auxfile, bib)
+        for job, (auxfile, bib) in jobs.items():
+            if job.result() < 2:    # try again next time after an error
+                state[auxfile] = bib
+
+        after = latex_state(basename)
+        if after == before and not rerun_requested(basename):
+            break
+        before = after
+        if not run(latex + ['-draftmode', basename + '.tex']):
+            print("pdflatex got an error")
+            return False
+
+    if not run(latex + [basename + '.tex']):
+        print("pdflatex got an error")
+        return False
+    return True
+
+def fillbib_watch(args):
+    '''
+    Keep compiling a document whenever it changes. Unlike running filltex at every save, the cache,
+    the connections to ADS and INSPIRE and the keys of the bib files stay in memory between builds.
+    '''
+    basename = args.texfile[0].split('.tex')[0]
+    watcher = Watcher(debounce=args.debounce)
+    state = {}
+    # pdflatex finds the aas_macros.sty that filltex downloads into the cache (the trailing separator keeps the default paths)
+    if cache_dir() not in os.environ.get('TEXINPUTS', '').split(os.pathsep):
+        os.environ['TEXINPUTS'] = os.pathsep.join(['.', cache_dir(), os.environ.get('TEXINPUTS', '')])
+    def watched_files():
+        sources = tex_inputs(basename + '.tex')
+        bibfiles = []
+        if os.path.isfile(basename + '.aux'):
+            bibfiles = [b + '.bib' for b in parse_aux(basename + '.aux', basename)[1]]
+        return sources, bibfiles
+
+    texchanged = True
+    try:
+        while True:
+            # What the files are like when the build starts: anything saved from now on needs another build
+            sources, bibfiles = watched_files()
+            times = {os.path.abspath(f): Watcher.mtime(f) for f in sources + bibfiles}
+            start = time.time()
+            try:
+                ok = build(args, texchanged=texchanged, state=state)
+            except Exception as e: # Report it, and keep watching: the next save may fix it
+                print("filltex got an error: {}: {}".format(type(e).__name__, e))
+                ok = False
+            print("filltex {} in {:.1f} s, watching for changes...".format("done" if ok else "failed", time.time() - start))
+
+            sources, bibfiles = watched_files()
+            # fillbib writes to the bib files itself: the versions it has read or written during the build are not changes
+            for b in bibfiles:
+                memo = BIB_INDEX.get(os.path.abspath(b))
+                if memo is not None and memo[1] == Watcher.mtime(b):
+                    times[os.path.abspath(b)] = memo[1]
+            watcher.set_files(sources + bibfiles, times)
+            changed = watcher.wait()
+            texchanged = bool(changed.intersection(os.path.abspath(f) for f in sources))
+    except KeyboardInterrupt:
+        print("filltex stopped watching")
+
+def fillbib_trace(args):
+    '''Print the summary of a trace file, e.g. the one written by filltex with FILLTEX_TRACE.'''
+    with open(args.tracefile[0], 'r') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    TRACE.summary(events, out=sys.stdout)
+
+
+def main():
+    '''The command line interface.'''
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--generate", action="store_true",
@@ -472,6 +2178,27 @@ if __name__ == "__main__":
     parser.add_argument("--num-authors-short", type=int,
             help="Number of authors to list if the number of authors is larger than max_num_authors"
                 "(iNSPIRE entries only, defaults to max-num-authors, requres --generate)")
+    parser.add_argument("--ads-workers", dest="ads_workers", type=int, default=4,
+            help="Number of concurrent queries to ADS (default: 4)")
+    parser.add_argument("--inspire-workers", dest="inspire_workers", type=int, default=2,
+            help="Number of concurrent queries to iNSPIRE (default: 2)")
+    parser.add_argument("--ads-batch", dest="ads_batch", type=int, default=500,
+            help="Number of bibcodes requested in a single ADS query (default: 500, requires ADS_TOKEN)")
+    parser.add_argument("--inspire-batch", dest="inspire_batch", type=int, default=50,
+            help="Number of texkeys requested in a single iNSPIRE query (default: 50)")
+    parser.add_argument("--offline", action="store_true",
+            help="Do not query ADS and iNSPIRE, only use the entries in the local cache")
+    parser.add_argument("--refresh", action="store_true",
+            help="Download all entries again, ignoring (and updating) the local cache")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+            help="Do not use the local cache of downloaded entries")
+    parser.add_argument("--hedge", action="store_true",
+            help="Look up DOIs, arXiv numbers and keys which are not found in both ADS and iNSPIRE at the same time")
+    parser.add_argument("--profile", action="store_true",
+            help="Print how long each stage took at the end")
+    parser.add_argument("--trace-json", dest="trace_json", default=os.environ.get('FILLTEX_TRACE'),
+            help="Append the timing of each stage and query to this file, as JSON lines "
+                "(default: $FILLTEX_TRACE)")
     subparsers = parser.add_subparsers(help="Subcommands")
 
     parser_tex = subparsers.add_parser("tex", help="Create a bibliography for a tex document")
@@ -481,17 +2208,63 @@ if __name__ == "__main__":
     parser_tex.add_argument('--updatepublished', dest='updatepublished', help="Replace ADS arxiv entries in .tex file if published", default=True, action='store_true')
     parser_tex.set_defaults(func=fillbib_tex)
 
+    parser_watch = subparsers.add_parser("watch", help="Compile a tex document again whenever it changes")
+    parser_watch.add_argument("--bibtex", help="The BiBTeX file to use (if not specified we try to find out)")
+    parser_watch.add_argument("texfile", nargs=1, help="The (La)TeX file to process")
+    parser_watch.add_argument('--journals', dest='journals', help="Replace known journal abbreviations", default=True, action='store_true')
+    parser_watch.add_argument('--updatepublished', dest='updatepublished', help="Replace ADS arxiv entries in .tex file if published", default=True, action='store_true')
+    parser_watch.add_argument('--debounce', type=float, default=0.5, help="Wait for this many seconds without changes before compiling (default: 0.5)")
+    parser_watch.set_defaults(func=fillbib_watch)
+
+    parser_refresh = subparsers.add_parser("refresh", help="Update the preprints in the bib files of a tex document which have been published")
+    parser_refresh.add_argument("--bibtex", help="The BiBTeX file to refresh (if not specified, all those of the document)")
+    parser_refresh.add_argument("texfile", nargs=1, help="The (La)TeX file to process")
+    parser_refresh.add_argument('--journals', dest='journals', help="Replace known journal abbreviations", default=True, action='store_true')
+    parser_refresh.add_argument('--updatepublished', dest='updatepublished', help="Replace ADS arxiv entries in .tex file if published", default=True, action='store_true')
+    parser_refresh.set_defaults(func=fillbib_refresh)
+
+    parser_project = subparsers.add_parser("project", help="Create the bibliographies of many tex documents sharing bib files")
+    parser_project.add_argument("path", nargs=1, help="A directory with the documents, or a file listing them")
+    parser_project.add_argument('--journals', dest='journals', help="Replace known journal abbreviations", default=True, action='store_true')
+    parser_project.add_argument('--updatepublished', dest='updatepublished', help="Replace ADS arxiv entries in .tex file if published", default=True, action='store_true')
+    parser_project.set_defaults(func=fillbib_project)
+
+    parser_tidy = subparsers.add_parser("tidy", help="Remove duplicate records from a bib file, and optionally sort it")
+    parser_tidy.add_argument("bibfile", nargs=1, help="The BiBTeX file to tidy up")
+    parser_tidy.add_argument("--sort", action="store_true", help="Sort the records by key")
+    parser_tidy.add_argument('--journals', dest='journals', help="Replace known journal abbreviations", default=True, action='store_true')
+    parser_tidy.set_defaults(func=fillbib_tidy)
+
+    parser_prefetch = subparsers.add_parser("prefetch", help="Download the citations of a tex document into the cache, without running LaTeX")
+    parser_prefetch.add_argument("texfile", nargs=1, help="The (La)TeX file to process")
+    parser_prefetch.set_defaults(func=fillbib_prefetch)
+
     parser_list = subparsers.add_parser("list", help="Create a bibliography given a list of ADS/iNSPIRE keys")
-    parser_list.add_argument("keys", nargs="+", help="ADS/iNSPIRE keys to fetch")
+    parser_list.add_argument("keys", nargs="*", help="ADS/iNSPIRE keys to fetch")
+    parser_list.add_argument("--stdin", action="store_true", help="Also read the keys from the standard input")
+    parser_list.add_argument("--format", choices=["bibtex", "ndjson"], default="bibtex",
+            help="Print the BibTeX entries in the order of the keys (bibtex, the default), or a JSON object "
+                "with key, backend, bibtex, status and latency for each key as soon as it is done (ndjson)")
     parser_list.set_defaults(func=fillbib_list)
 
+    parser_trace = subparsers.add_parser("trace", help="Summarize a file written with --trace-json")
+    parser_trace.add_argument("tracefile", nargs=1, help="The trace file")
+    parser_trace.set_defaults(func=fillbib_trace)
+
 
     args = parser.parse_args()
+    if args.func is fillbib_list and not args.keys and not args.stdin:
+        parser_list.error("give some keys, or --stdin")
+    if args.func is not fillbib_trace:
+        TRACE.configure(args.trace_json, args.profile)
     args.func(args)
+    if args.profile:
+        TRACE.summary()
     #try:
     #    args.func(args)
     #except:
     #    parser.print_usage()
 
 
-
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,39 @@ exit
 fi
 
 
+# Files shared by all documents (the same directory as fillbib's cache)
+CACHE=${FILLTEX_CACHE:-${XDG_CACHE_HOME:-$HOME/.cache}/filltex}
+
+# Get the journal abbreviations from ADS. They are downloaded once into the cache, not into every
+# document's directory, and LaTeX finds them there through TEXINPUTS (a copy next to the document still wins).
+aasmacros() {
+  grep -q 'aas_macros' $1 2>/dev/null || return # check if you need them
+  if ! grep -q '\\def\\apj' ${CACHE}/aas_macros.sty 2>/dev/null; then # missing, or not what we expect (e.g. an error page)
+    mkdir -p ${CACHE}
+    if curl -s -f 'https://adsabs.harvard.edu/abs_doc/aas_macros.sty' > ${CACHE}/aas_macros.sty.$$ && grep -q '\\def\\apj' ${CACHE}/aas_macros.sty.$$; then
+      mv ${CACHE}/aas_macros.sty.$$ ${CACHE}/aas_macros.sty
+    else
+      echo "Could not download aas_macros.sty"
+      rm -f ${CACHE}/aas_macros.sty.$$
+    fi
+  fi
+  export TEXINPUTS=.:${CACHE}:${TEXINPUTS}
+}
+
+
+# Keep compiling the document whenever it (or its bibliography) changes
+if [[ $1 = 'watch' ]]; then
+  shift
+  for arg in "$@"; do # the tex file, among the options
+    if [[ $arg != -* && -f ${arg%.tex}.tex ]]; then
+      aasmacros ${arg%.tex}.tex
+      break
+    fi
+  done
+  exec fillbib watch "$@"
+fi
+
+
 # Actual script
 #SCRIPT=`realpath $0`
 #SCRIPT_LOCATION=`dirname $SCRIPT`
@@ -31,40 +64,116 @@ fi
 FILE=${1%.*}
 echo "filltex is compiling ${FILE}.tex"
 
-# Get the journal abbreviations from ADS
-if grep -q 'aas_macros' ${FILE}.tex; then # check if you need them
-  if [ ! -f 'aas_macros.sty' ]; then
-    curl -s 'https://adsabs.harvard.edu/abs_doc/aas_macros.sty' > 'aas_macros.sty'
+aasmacros ${FILE}.tex
+
+# If FILLTEX_TRACE is set to a file name, the time taken by each stage is written there as JSON lines
+# (fillbib adds the details of its own stages), and a summary is printed at the end. The file is emptied
+# first, so that the summary is that of this build only.
+[[ -n $FILLTEX_TRACE ]] && : > $FILLTEX_TRACE
+now() {
+  if [[ -n $EPOCHREALTIME ]]; then echo ${EPOCHREALTIME/,/.}; else date +%s; fi
+}
+stage() {
+  local name=$1; shift
+  local start=$(now)
+  "$@"
+  local status=$?
+  if [[ -n $FILLTEX_TRACE ]]; then
+    local end=$(now)
+    echo "{\"name\": \"$name\", \"ts\": $start, \"dur\": $(awk "BEGIN {print $end - $start}"), \"status\": $status}" >> $FILLTEX_TRACE
   fi
-fi
+  return $status
+}
 
 # The pdflatex command returns 0 if everyting is ok, or 1 if he gets an error. If there's an error, I want the script to exit.
-pdflatex --synctex=1 -halt-on-error ${FILE}.tex
-[[ $? -eq 1 ]] && echo "pdflatex got an error" && exit
+# Intermediate passes are run with -draftmode (no pdf is written), only the last one produces the pdf.
+runlatex() {
+  stage "pdflatex $1" pdflatex --synctex=1 -halt-on-error $1 ${FILE}.tex
+  [[ $? -eq 1 ]] && echo "pdflatex got an error" && exit
+}
+
+# Checksum of what pdflatex reads back in the next pass. When this stops changing, we are done.
+latexstate() {
+  cat *.aux ${FILE}.toc ${FILE}.lof ${FILE}.lot ${FILE}.out ${FILE}.bbl 2>/dev/null | cksum
+}
+
+# Checksum of what bibtex reads for an aux file: its citation data (and that of the aux files it reads
+# with \@input), and its bib files
+bibstate() {
+  {
+    grep -h -E '^\\(citation|bibdata|bibstyle)' $1 $(sed -n 's/^\\@input{\(.*\)}/\1/p' $1) 2>/dev/null
+    for bib in $(sed -n 's/^\\bibdata{\(.*\)}/\1/p' $1 | tr ',' ' '); do
+      cat ${bib%.bib}.bib 2>/dev/null
+    done
+  } | cksum
+}
+
+# Run bibtex on an aux file, unless its citation data and bib files did not change since the last time.
+# The output is printed at the end, so that bibtex runs in parallel do not mix their messages.
+runbibtex() {
+  local state=$(bibstate $1)
+  if [[ -f ${1%.aux}.bbl && "$state" == "$(cat ${1%.aux}.bibstate 2>/dev/null)" ]]; then
+    return
+  fi
+  local output
+  output=$(stage bibtex bibtex $1 2>&1)
+  local status=$?
+  echo "$output"
+  # bibtex returns 1 for warnings and 2 for errors: try again next time after an error
+  [[ $status -lt 2 ]] && echo "$state" > ${1%.aux}.bibstate
+}
+
+# Number of bibtex runs at the same time
+NCORES=$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 1)
 
-# Fill the bib fil with the ADS and INSPIRE references.
-# Use python 2
-#python ${SCRIPT_LOCATION}/fillbib.py "${FILE}"
-# Use python 3
-#python3 ${SCRIPT_LOCATION}/fillbib.py "${FILE}"
-#python ../filltex/fillbib.py tex ${FILE}
-fillbib tex ${FILE}
+# pdflatex asks explicitly for another pass
+rerunrequested() {
+  grep -q -E '(Rerun to get|Please rerun|Rerun LaTeX)' ${FILE}.log 2>/dev/null
+}
 
+MAXPASSES=5
 
-for i in {1..2}; do
+BEFORE=$(latexstate)
 
-  # Fill the bbl file from the bib file
+# Start downloading the citations found in the tex sources while pdflatex runs the first pass.
+# fillbib tex below then finds them in the cache, and takes care of anything the scanner missed.
+stage prefetch fillbib prefetch ${FILE} > /dev/null 2>&1 &
+PREFETCH=$!
+runlatex -draftmode
+wait $PREFETCH
+
+for (( pass=2; pass<MAXPASSES; pass++ )); do
+
+  # Fill the bib fil with the ADS and INSPIRE references. This exits straight away if the citations did not change.
+  stage fillbib fillbib tex ${FILE}
+
+  # Fill the bbl files from the bib files, in parallel, for the aux files whose citations or bib files changed
+  # (there are several with multibib or chapterbib). Aux files without a bibliography are left alone.
+  running=0
   for file in *.aux ; do
-      bibtex $file
+    grep -q '^\\bibdata' $file || continue
+    runbibtex $file &
+    running=$((running+1))
+    if [[ $running -ge $NCORES ]]; then
+      wait
+      running=0
+    fi
   done
+  wait
 
-  pdflatex --synctex=1 -halt-on-error ${FILE}.tex
-  [[ $? -eq 1 ]] && echo "pdflatex got an error" && exit
-
-  pdflatex --synctex=1 -halt-on-error ${FILE}.tex
-  [[ $? -eq 1 ]] && echo "pdflatex got an error" && exit
+  AFTER=$(latexstate)
+  if [[ "$AFTER" == "$BEFORE" ]] && ! rerunrequested; then
+    break
+  fi
+  BEFORE=$AFTER
+  runlatex -draftmode
 done
 
+# Final pass, which writes the pdf
+runlatex
+
+[[ -n $FILLTEX_TRACE ]] && fillbib trace $FILLTEX_TRACE
+
 # Count the words
 #perl ${SCRIPT_LOCATION}/texcount.pl "${FILE}".tex
 texcount "${FILE}".tex